@@ -3,22 +3,34 @@ import webbrowser
 import re
 import os
 import random
+import time
+import heapq
+import threading
+import queue
+import atexit
 import logging
+import logging.handlers
 import numpy as np
 from dotenv import load_dotenv
-from typing import TypedDict, List, Tuple
-from langgraph.graph import StateGraph, START, END
-from astrapy import DataAPIClient
-
-# Configure logging
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import TypedDict, List, Optional, Tuple
+
+# Configure logging: records are formatted by the QueueHandler and written to file/console by a
+# background QueueListener, so log calls on the hot path never block on disk I/O
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('D:\\Synapsewerx_Projects\\Customer_Recommendations\\workflow.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('D:\\Synapsewerx_Projects\\Customer_Recommendations\\workflow.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on exit
 logger = logging.getLogger(__name__)
 
 # Set astrapy logging to INFO for debugging, revert to WARNING after confirming
@@ -31,6 +43,34 @@ load_dotenv(r"D:\Synapsewerx_Projects\Customer_Recommendations\.env")
 ASTRA_DB_ENDPOINT = os.getenv("ASTRA_DB_ENDPOINT")
 ASTRA_DB_TOKEN = os.getenv("ASTRA_DB_TOKEN")
 
+# Number of recommendations returned per approach
+TOP_RECOMMENDATIONS = 5
+# Ads fetched per interest vector; over-fetches the display size because ads without a video link
+# and repeated products or URLs are dropped after the search
+PER_VECTOR_SEARCH_LIMIT = 10
+
+# Query string appended to every ad video link so it autoplays muted
+_AUTOPLAY_SUFFIX = "&autoplay=1&mute=1"
+
+# Upper bound on concurrent per-vector similarity searches
+MAX_SEARCH_WORKERS = 8
+
+# Retries (with exponential backoff) when a cached UserId no longer has any entries
+USER_ID_REFRESH_ATTEMPTS = 3
+USER_ID_REFRESH_BACKOFF_SECONDS = 0.5
+
+# How long the in-process advertisement cache is trusted before reloading it
+AD_CACHE_TTL_SECONDS = float(os.getenv("AD_CACHE_TTL_SECONDS", "300"))
+
+# Store the advertisement cache as int8 (4x smaller) instead of float32; off by default for A/B runs
+QUANTIZE_AD_CACHE = os.getenv("QUANTIZE_AD_CACHE", "false").lower() in ("1", "true", "yes")
+AD_QUANT_SCALE = 127  # Unit-vector components in [-1, 1] map to int8 [-127, 127]
+AD_QUANT_BLOCK_ROWS = 256  # int8 rows dequantized per float32 GEMV block; keeps the scratch buffer cache-sized
+
+# Per-customer memo of aggregated vectors: entry lifetime and maximum number of customers kept
+AGG_VECTOR_CACHE_TTL_SECONDS = float(os.getenv("AGG_VECTOR_CACHE_TTL_SECONDS", "300"))
+AGG_VECTOR_CACHE_SIZE = 1024
+
 logger.info("Environment variables loaded")
 logger.debug("ASTRA_DB_ENDPOINT: %s", ASTRA_DB_ENDPOINT)
 logger.debug("ASTRA_DB_TOKEN: %s", ASTRA_DB_TOKEN)
@@ -41,9 +81,9 @@ class WorkflowState(TypedDict):
     ad_url: str
     ad_url_agg: str  # For aggregated approach
     user_interests: dict
-    user_vectors: list  # Store multiple vectors per UserId (for Aggregation Approach)
-    user_vectors_with_interests: list  # Store list of (vector, InterestName, InterestDescription) tuples
-    user_vector_agg: list  # Store aggregated vector
+    user_vectors: list  # Store multiple float32 vectors per UserId (for Aggregation Approach)
+    user_vectors_with_interests: list  # Store list of (float32 vector, InterestName, InterestDescription) tuples
+    user_vector_agg: np.ndarray  # Store aggregated float32 vector
     product: str
     product_agg: str  # For aggregated approach
     similarity_score: float
@@ -53,186 +93,266 @@ class WorkflowState(TypedDict):
     top_recommendations: list
     top_recommendations_agg: list  # For aggregated approach
 
+# Astra DB handles, created on first use and reused for the rest of the session
+_client = None
+_db = None
+_collections = {}
+
+def _get_collection(name: str):
+    """Return a cached handle to the named Astra DB collection, connecting on first use."""
+    global _client, _db
+    if _db is None:
+        from astrapy import DataAPIClient  # Deferred so the import cost is only paid on first connect
+
+        logger.debug("Connecting to Astra DB at %s", ASTRA_DB_ENDPOINT)
+        _client = DataAPIClient(ASTRA_DB_TOKEN)
+        _db = _client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
+    if name not in _collections:
+        _collections[name] = _db.get_collection(name)
+        logger.info("Connected to %s collection", name)
+    return _collections[name]
+
+# In-process copy of the advertisement catalog as one (vecs, products, video_links) snapshot, replaced
+# as a whole so concurrent searches never mix rows from two loads (vecs L2-normalized; int8 when quantized)
+_ad_cache = None
+_ad_cache_loaded_at = 0.0
+# Held while a background reload is running so an expired cache starts only one
+_ad_cache_reload_lock = threading.Lock()
+
+def _reload_ad_cache() -> None:
+    """Fetch all ad vectors and metadata into NumPy arrays; a failed load keeps the current snapshot."""
+    global _ad_cache, _ad_cache_loaded_at
+    try:
+        ads = [ad for ad in _get_collection("advertisements").find(
+            {},
+            projection={"_id": 0, "product": 1, "video_link": 1, "$vector": 1}
+        ) if ad.get("$vector")]
+        if not ads:
+            logger.warning("No advertisement vectors available, falling back to Astra DB similarity search")
+            return
+
+        vecs = np.asarray([ad["$vector"] for ad in ads], dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vecs /= norms
+        _ad_cache = (
+            _quantize(vecs) if QUANTIZE_AD_CACHE else vecs,
+            np.array([ad.get("product", "") for ad in ads]),
+            np.array([ad.get("video_link", "") for ad in ads]),
+        )
+        _ad_cache_loaded_at = time.monotonic()
+        logger.info("Loaded %s advertisements into the in-process cache", len(ads))
+    except Exception as e:
+        logger.warning("Failed to load advertisement cache: %s, falling back to Astra DB similarity search", str(e))
+
+def _background_reload_ad_cache() -> None:
+    try:
+        _reload_ad_cache()
+    finally:
+        _ad_cache_reload_lock.release()
+
+def _load_ad_cache() -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Return the current ad cache snapshot, or None when no catalog could be loaded.
+
+    Only the first call (or one made while the cache is still empty) loads synchronously. Once the
+    TTL has expired a daemon thread reloads the catalog while the stale snapshot keeps serving, so
+    no request waits for the reload.
+    """
+    if _ad_cache is None:
+        _reload_ad_cache()
+    elif (time.monotonic() - _ad_cache_loaded_at >= AD_CACHE_TTL_SECONDS
+          and _ad_cache_reload_lock.acquire(blocking=False)):
+        threading.Thread(target=_background_reload_ad_cache, name="ad-cache-reload", daemon=True).start()
+    return _ad_cache
+
+def _quantize(vectors: np.ndarray) -> np.ndarray:
+    """Quantize L2-normalized float32 vectors to int8 with a fixed AD_QUANT_SCALE."""
+    return np.clip(np.round(vectors * AD_QUANT_SCALE), -AD_QUANT_SCALE, AD_QUANT_SCALE).astype(np.int8)
+
+def _local_top_ads(ad_cache: Tuple[np.ndarray, np.ndarray, np.ndarray], user_vector: np.ndarray, limit: int) -> List[dict]:
+    """Score a unit-length user vector against the cached ads and return the top matches, best first."""
+    # Ads and user vectors are both L2-normalized up front, so cosine similarity is a plain dot product.
+    # Astra reports cosine similarity rescaled to [0, 1] as (1 + cos) / 2; keep the same scale
+    # so agent_3's similarity threshold means the same thing for cached results
+    ad_vecs, ad_products, ad_video_links = ad_cache
+    if ad_vecs.dtype == np.int8:
+        # Integer matmul has no BLAS path and would upcast the whole matrix, so dequantize a block
+        # of rows at a time and score it with a float32 GEMV against the unquantized query
+        cosines = np.empty(len(ad_vecs), dtype=np.float32)
+        for start in range(0, len(ad_vecs), AD_QUANT_BLOCK_ROWS):
+            block = ad_vecs[start:start + AD_QUANT_BLOCK_ROWS]
+            cosines[start:start + len(block)] = block.astype(np.float32) @ user_vector
+        cosines /= AD_QUANT_SCALE
+    else:
+        cosines = ad_vecs @ user_vector
+    scores = (cosines + 1.0) * 0.5
+    k = min(limit, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [
+        {"product": str(ad_products[i]), "video_link": str(ad_video_links[i]), "$similarity": float(scores[i])}
+        for i in top
+    ]
+
 # Placeholder for facial recognition
 def dummy_facial_recognition() -> str:
     logger.info("Simulating facial recognition")
     return "003dL000008HU8rQAG"
 
 # Function to aggregate vectors
-def aggregate_vectors(vectors: List[List[float]]) -> List[float]:
-    """Aggregate multiple vectors into a single vector by averaging."""
+def aggregate_vectors(vectors: List[np.ndarray]) -> np.ndarray:
+    """Aggregate the raw user vectors into a single unit-length float32 vector (the normalized mean)."""
     if not vectors:
-        return []
+        return np.empty(0, dtype=np.float32)
     try:
-        # Convert list of vectors to numpy array and compute mean
-        vectors_array = np.array(vectors)
-        aggregated_vector = np.mean(vectors_array, axis=0).tolist()
-        logger.debug("Aggregated vector (first 5 dims): %s", aggregated_vector[:5])
+        # Stack into one contiguous float32 buffer and reduce it in place
+        buf = np.empty((len(vectors), len(vectors[0])), dtype=np.float32)
+        np.stack(vectors, out=buf)
+        aggregated_vector = np.add.reduce(buf, axis=0)
+        # Renormalizing the sum gives the mean's direction, which is all cosine similarity sees
+        norm = np.linalg.norm(aggregated_vector)
+        if norm > 0:
+            aggregated_vector /= norm
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Aggregated vector (first 5 dims): %s", aggregated_vector[:5])
         return aggregated_vector
     except Exception as e:
         logger.error("Error aggregating vectors: %s", str(e))
-        return []
+        return np.empty(0, dtype=np.float32)
+
+# Aggregated vector per CustomerID as (computed_at, vector), oldest first
+_aggregated_vectors = {}
+
+def get_aggregated_vector(customer_id: str, vectors: List[np.ndarray]) -> np.ndarray:
+    """Return the customer's aggregated vector, reusing the memoized one until its TTL expires."""
+    cached = _aggregated_vectors.get(customer_id)
+    if cached is not None and time.monotonic() - cached[0] < AGG_VECTOR_CACHE_TTL_SECONDS:
+        logger.debug("Reusing aggregated vector for CustomerID: %s", customer_id)
+        return cached[1]
+    aggregated_vector = aggregate_vectors(vectors)
+    if len(aggregated_vector) > 0:
+        _aggregated_vectors.pop(customer_id, None)
+        if len(_aggregated_vectors) >= AGG_VECTOR_CACHE_SIZE:
+            del _aggregated_vectors[next(iter(_aggregated_vectors))]  # Evict the oldest entry
+        _aggregated_vectors[customer_id] = (time.monotonic(), aggregated_vector)
+    return aggregated_vector
+
+# Function to collect interests and vectors from userinterests entries
+def collect_user_data(entries: list, default_name: str = "", default_description: str = "") -> Tuple[dict, list, list]:
+    """Build the joined interests, raw float32 vectors and (unit vector, InterestName, InterestDescription) tuples in one pass."""
+    # Dicts dedupe like sets but keep first-seen order, so the joined strings are stable
+    names = {}
+    descs = {}
+    user_vectors = []
+    user_vectors_with_interests = []
+    for entry in entries:
+        names[entry.get("InterestName", default_name)] = None
+        descs[entry.get("InterestDescription", default_description)] = None
+        vector = entry.get("$vector")
+        if not vector:
+            continue  # Skip entries without an embedding
+        # Keep vectors as float32 arrays from here on; convert back to lists only for Astra queries.
+        # user_vectors stays raw so the aggregate is the true mean, while the per-interest copy is
+        # L2-normalized for dot-product scoring (cosine ignores the norm, so Astra results are unchanged)
+        vector = np.asarray(vector, dtype=np.float32)
+        user_vectors.append(vector)
+        norm = np.linalg.norm(vector)
+        unit_vector = vector / norm if norm > 0 else vector
+        user_vectors_with_interests.append(
+            (unit_vector, entry.get("InterestName", ""), entry.get("InterestDescription", ""))
+        )
+
+    user_interests = {
+        "InterestName": ", ".join(names),
+        "InterestDescription": ", ".join(descs)
+    }
+    return user_interests, user_vectors, user_vectors_with_interests
+
+# Distinct UserIds of the userinterests collection, fetched once and refreshed on a miss
+_distinct_user_ids = []
+
+def _get_distinct_user_ids(collection, refresh: bool = False) -> List[str]:
+    """Return the cached list of distinct UserIds, fetching it on first use or when refresh is set."""
+    global _distinct_user_ids
+    if refresh or not _distinct_user_ids:
+        _distinct_user_ids = [user_id for user_id in collection.distinct("UserId") if user_id]
+        logger.info("Cached %s distinct UserIds", len(_distinct_user_ids))
+    return _distinct_user_ids
 
 # Function to get a random user ID from the userinterests collection
 def get_random_user_id(collection) -> Tuple[str, dict, list, list, list]:
     """Get a random user ID, their interests, vectors, vectors with interest details, and aggregated vector."""
     try:
-        # Get total document count with upper_bound for Astra DB compatibility
-        total_docs = collection.count_documents({}, upper_bound=1000)
-        logger.info("Total documents in userinterests: %s", total_docs)
-        
-        if total_docs == 0:
-            logger.error("No documents found in userinterests collection")
-            return None, None, [], [], []
-
-        # Method 1: Skip-based approach WITH sort clause as required by Astra DB
-        try:
-            # Use a smaller skip value to avoid timeouts (skip at most 100 docs)
-            max_skip = min(total_docs - 1, 100) if total_docs > 1 else 0
-            skip = random.randint(0, max_skip)
-            logger.info("Using optimized skip-based approach with skip=%s", skip)
-            
-            # Get a batch of documents with sort clause (required by Astra DB for skip)
-            batch_size = min(10, total_docs - skip)
-            documents = list(collection.find(
-                {},
-                projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1},
-                sort={"UserId": 1},  # Sort by UserId to satisfy Astra DB requirement
-                skip=skip,
-                limit=batch_size
-            ))
-            
-            if documents:
-                # Choose a random document and fetch all entries for that UserId
-                random_doc = random.choice(documents)
-                customer_id = random_doc["UserId"]
-                all_entries = list(collection.find(
-                    {"UserId": customer_id},
-                    projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-                ))
-                
-                if not all_entries:
-                    logger.error("No entries found for UserId: %s", customer_id)
-                    return None, None, [], [], []
-                
-                # Aggregate interests and collect all vectors with interest details
-                user_interests = {
-                    "InterestName": ", ".join(set(entry.get("InterestName", "") for entry in all_entries)),
-                    "InterestDescription": ", ".join(set(entry.get("InterestDescription", "") for entry in all_entries))
-                }
-                user_vectors = [entry.get("$vector", []) for entry in all_entries]
-                user_vectors = [v for v in user_vectors if v]  # Filter out empty vectors
-                # Create list of (vector, InterestName, InterestDescription) tuples
-                user_vectors_with_interests = [
-                    (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
-                    for entry in all_entries if entry.get("$vector", [])
-                ]
-                
-                if not user_vectors:
-                    logger.error("No valid $vector found for UserId: %s", customer_id)
-                    return customer_id, user_interests, [], [], []
-                
-                # Aggregate vectors
-                user_vector_agg = aggregate_vectors(user_vectors)
-                if not user_vector_agg:
-                    logger.error("Failed to aggregate vectors for UserId: %s", customer_id)
-                    return customer_id, user_interests, user_vectors, [], []
-                
-                return customer_id, user_interests, user_vectors, user_vectors_with_interests, user_vector_agg
-        except Exception as e:
-            logger.warning("Optimized skip approach failed: %s, trying pagination approach", str(e))
-
-        # Method 2: Get multiple pages and choose randomly (no skip)
-        try:
-            page_docs = list(collection.find(
-                {},
-                projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1},
-                limit=50
+        all_entries = []
+        for attempt in range(USER_ID_REFRESH_ATTEMPTS):
+            # Refresh the cached UserIds if the previous pick no longer has any entries
+            user_ids = _get_distinct_user_ids(collection, refresh=attempt > 0)
+            if not user_ids:
+                logger.error("No documents found in userinterests collection")
+                return None, None, [], [], np.empty(0, dtype=np.float32)
+
+            customer_id = random.choice(user_ids)
+            all_entries = list(collection.find(
+                {"UserId": customer_id},
+                projection={"_id": 0, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
             ))
-            
-            if page_docs:
-                random_doc = random.choice(page_docs)
-                customer_id = random_doc["UserId"]
-                all_entries = list(collection.find(
-                    {"UserId": customer_id},
-                    projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-                ))
-                
-                if not all_entries:
-                    logger.error("No entries found for UserId: %s", customer_id)
-                    return None, None, [], [], []
-                
-                user_interests = {
-                    "InterestName": ", ".join(set(entry.get("InterestName", "") for entry in all_entries)),
-                    "InterestDescription": ", ".join(set(entry.get("InterestDescription", "") for entry in all_entries))
-                }
-                user_vectors = [entry.get("$vector", []) for entry in all_entries]
-                user_vectors = [v for v in user_vectors if v]
-                user_vectors_with_interests = [
-                    (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
-                    for entry in all_entries if entry.get("$vector", [])
-                ]
-                
-                if not user_vectors:
-                    logger.error("No valid $vector found for UserId: %s", customer_id)
-                    return customer_id, user_interests, [], [], []
-                
-                user_vector_agg = aggregate_vectors(user_vectors)
-                if not user_vector_agg:
-                    logger.error("Failed to aggregate vectors for UserId: %s", customer_id)
-                    return customer_id, user_interests, user_vectors, [], []
-                
-                return customer_id, user_interests, user_vectors, user_vectors_with_interests, user_vector_agg
-        except Exception as e:
-            logger.warning("Pagination approach failed: %s, trying simplified approach", str(e))
-
-        # Method 3: Last resort - just get the first document
-        try:
-            doc = collection.find_one(
-                {},
-                projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-            )
-            
-            if doc:
-                customer_id = doc["UserId"]
-                all_entries = list(collection.find(
-                    {"UserId": customer_id},
-                    projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-                ))
-                
-                if not all_entries:
-                    logger.error("No entries found for UserId: %s", customer_id)
-                    return None, None, [], [], []
-                
-                user_interests = {
-                    "InterestName": ", ".join(set(entry.get("InterestName", "") for entry in all_entries)),
-                    "InterestDescription": ", ".join(set(entry.get("InterestDescription", "") for entry in all_entries))
-                }
-                user_vectors = [entry.get("$vector", []) for entry in all_entries]
-                user_vectors = [v for v in user_vectors if v]
-                user_vectors_with_interests = [
-                    (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
-                    for entry in all_entries if entry.get("$vector", [])
-                ]
-                
-                if not user_vectors:
-                    logger.error("No valid $vector found for UserId: %s", customer_id)
-                    return customer_id, user_interests, [], [], []
-                
-                user_vector_agg = aggregate_vectors(user_vectors)
-                if not user_vector_agg:
-                    logger.error("Failed to aggregate vectors for UserId: %s", customer_id)
-                    return customer_id, user_interests, user_vectors, [], []
-                
-                return customer_id, user_interests, user_vectors, user_vectors_with_interests, user_vector_agg
-        except Exception as e:
-            logger.error("All approaches failed: %s", str(e))
-            
-        return None, None, [], [], []
-            
+            if all_entries:
+                break
+
+            logger.warning("No entries found for cached UserId: %s", customer_id)
+            if attempt + 1 < USER_ID_REFRESH_ATTEMPTS:
+                backoff = USER_ID_REFRESH_BACKOFF_SECONDS * 2 ** attempt
+                logger.info("Refreshing cached UserIds in %ss", backoff)
+                time.sleep(backoff)
+
+        if not all_entries:
+            logger.error("No entries found after %s attempts", USER_ID_REFRESH_ATTEMPTS)
+            return None, None, [], [], np.empty(0, dtype=np.float32)
+
+        # Aggregate interests and collect all vectors with interest details
+        user_interests, user_vectors, user_vectors_with_interests = collect_user_data(all_entries)
+
+        if not user_vectors:
+            logger.error("No valid $vector found for UserId: %s", customer_id)
+            return customer_id, user_interests, [], [], []
+
+        # Aggregate vectors
+        user_vector_agg = get_aggregated_vector(customer_id, user_vectors)
+        if len(user_vector_agg) == 0:
+            logger.error("Failed to aggregate vectors for UserId: %s", customer_id)
+            return customer_id, user_interests, user_vectors, [], []
+
+        return customer_id, user_interests, user_vectors, user_vectors_with_interests, user_vector_agg
+
     except Exception as e:
         logger.error("Error in get_random_user_id: %s", str(e))
-        return None, None, [], [], []
+        return None, None, [], [], np.empty(0, dtype=np.float32)
+
+# Default values for every WorkflowState key; values are never mutated in place, so
+# sharing the empty containers between returned states is safe
+_EMPTY_STATE_TEMPLATE = dict(
+    customer_id="",
+    user_interests={},
+    user_vectors=[],
+    user_vectors_with_interests=[],
+    user_vector_agg=np.empty(0, dtype=np.float32),
+    ad_url_agg="",
+    product="",
+    product_agg="",
+    similarity_score=0.0,
+    similarity_score_agg=0.0,
+    play_ad=False,
+    play_ad_agg=False,
+    top_recommendations=[],
+    top_recommendations_agg=[]
+)
+
+def _state(state: WorkflowState, **overrides) -> WorkflowState:
+    """Build a full WorkflowState from the defaults, carrying ad_url over from state and applying overrides."""
+    out = dict(_EMPTY_STATE_TEMPLATE)
+    out["ad_url"] = state.get("ad_url", "")
+    out.update(overrides)
+    return out
 
 # Agent 1: CustomerID Selection Node
 def agent_1_node(state: WorkflowState) -> WorkflowState:
@@ -248,50 +368,14 @@ def agent_1_node(state: WorkflowState) -> WorkflowState:
             if not ASTRA_DB_ENDPOINT or not ASTRA_DB_ENDPOINT.startswith(("http://", "https://")):
                 logger.error("ASTRA_DB_ENDPOINT is missing or invalid")
                 print("Error: ASTRA_DB_ENDPOINT is missing or invalid")
-                return {
-                    "customer_id": "",
-                    "user_interests": {},
-                    "user_vectors": [],
-                    "user_vectors_with_interests": [],
-                    "user_vector_agg": [],
-                    "ad_url": state.get("ad_url", ""),
-                    "ad_url_agg": "",
-                    "product": "",
-                    "product_agg": "",
-                    "similarity_score": 0.0,
-                    "similarity_score_agg": 0.0,
-                    "play_ad": False,
-                    "play_ad_agg": False,
-                    "top_recommendations": [],
-                    "top_recommendations_agg": []
-                }
+                return _state(state)
 
             if not ASTRA_DB_TOKEN:
                 logger.error("ASTRA_DB_TOKEN is missing")
                 print("Error: ASTRA_DB_TOKEN is missing")
-                return {
-                    "customer_id": "",
-                    "user_interests": {},
-                    "user_vectors": [],
-                    "user_vectors_with_interests": [],
-                    "user_vector_agg": [],
-                    "ad_url": state.get("ad_url", ""),
-                    "ad_url_agg": "",
-                    "product": "",
-                    "product_agg": "",
-                    "similarity_score": 0.0,
-                    "similarity_score_agg": 0.0,
-                    "play_ad": False,
-                    "play_ad_agg": False,
-                    "top_recommendations": [],
-                    "top_recommendations_agg": []
-                }
-
-            logger.debug("Connecting to Astra DB at %s", ASTRA_DB_ENDPOINT)
-            client = DataAPIClient(ASTRA_DB_TOKEN)
-            db = client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
-            userinterests_collection = db.get_collection("userinterests")
-            logger.info("Connected to userinterests collection")
+                return _state(state)
+
+            userinterests_collection = _get_collection("userinterests")
 
             # Get random user using improved approach
             customer_id, user_interests, user_vectors, user_vectors_with_interests, user_vector_agg = get_random_user_id(userinterests_collection)
@@ -299,92 +383,40 @@ def agent_1_node(state: WorkflowState) -> WorkflowState:
             if not customer_id:
                 logger.error("Could not retrieve random customer ID")
                 print("Error: Could not retrieve random customer ID")
-                return {
-                    "customer_id": "",
-                    "user_interests": {},
-                    "user_vectors": [],
-                    "user_vectors_with_interests": [],
-                    "user_vector_agg": [],
-                    "ad_url": state.get("ad_url", ""),
-                    "ad_url_agg": "",
-                    "product": "",
-                    "product_agg": "",
-                    "similarity_score": 0.0,
-                    "similarity_score_agg": 0.0,
-                    "play_ad": False,
-                    "play_ad_agg": False,
-                    "top_recommendations": [],
-                    "top_recommendations_agg": []
-                }
+                return _state(state)
 
             if not user_vectors:
                 logger.error("No $vector found for user: %s", customer_id)
                 print("Error: No embedding vector for user")
-                return {
-                    "customer_id": customer_id,
-                    "user_interests": user_interests,
-                    "user_vectors": [],
-                    "user_vectors_with_interests": [],
-                    "user_vector_agg": [],
-                    "ad_url": state.get("ad_url", ""),
-                    "ad_url_agg": "",
-                    "product": "",
-                    "product_agg": "",
-                    "similarity_score": 0.0,
-                    "similarity_score_agg": 0.0,
-                    "play_ad": False,
-                    "play_ad_agg": False,
-                    "top_recommendations": [],
-                    "top_recommendations_agg": []
-                }
+                return _state(state, customer_id=customer_id, user_interests=user_interests)
 
             logger.info("Selected random CustomerID: %s, Interests: %s, Number of Vectors: %s", 
                         customer_id, user_interests, len(user_vectors))
             print(f"Selected random CustomerID: {customer_id}")
-            return {
-                "customer_id": customer_id,
-                "user_interests": user_interests,
-                "user_vectors": user_vectors,
-                "user_vectors_with_interests": user_vectors_with_interests,
-                "user_vector_agg": user_vector_agg,
-                "ad_url": state.get("ad_url", ""),
-                "ad_url_agg": "",
-                "product": "",
-                "product_agg": "",
-                "similarity_score": 0.0,
-                "similarity_score_agg": 0.0,
-                "play_ad": False,
-                "play_ad_agg": False,
-                "top_recommendations": [],
-                "top_recommendations_agg": []
-            }
+            return _state(
+                state,
+                customer_id=customer_id,
+                user_interests=user_interests,
+                user_vectors=user_vectors,
+                user_vectors_with_interests=user_vectors_with_interests,
+                user_vector_agg=user_vector_agg
+            )
 
         elif choice == "2":
-            logger.debug("Connecting to Astra DB at %s", ASTRA_DB_ENDPOINT)
-            client = DataAPIClient(ASTRA_DB_TOKEN)
-            db = client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
-            userinterests_collection = db.get_collection("userinterests")
-            logger.info("Connected to userinterests collection")
+            userinterests_collection = _get_collection("userinterests")
 
             customer_id = dummy_facial_recognition()
             # Query userinterests collection for all entries of the CustomerID
             entries = list(userinterests_collection.find(
                 {"UserId": customer_id},
-                projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
+                projection={"_id": 0, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
             ))
             
             if entries:
-                user_interests = {
-                    "InterestName": ", ".join(set(entry.get("InterestName", "Unknown") for entry in entries)),
-                    "InterestDescription": ", ".join(set(entry.get("InterestDescription", "Placeholder interest") for entry in entries))
-                }
-                user_vectors = [entry.get("$vector", []) for entry in entries]
-                user_vectors = [v for v in user_vectors if v]  # Filter out empty vectors
-                user_vectors_with_interests = [
-                    (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
-                    for entry in entries if entry.get("$vector", [])
-                ]
-                user_vector_agg = aggregate_vectors(user_vectors)
+                user_interests, user_vectors, user_vectors_with_interests = collect_user_data(
+                    entries, default_name="Unknown", default_description="Placeholder interest"
+                )
+                user_vector_agg = get_aggregated_vector(customer_id, user_vectors)
                 logger.info("Retrieved data for CustomerID: %s, Interests: %s, Number of Vectors: %s", 
                             customer_id, user_interests, len(user_vectors))
             else:
@@ -392,258 +424,204 @@ def agent_1_node(state: WorkflowState) -> WorkflowState:
                 user_interests = {"InterestName": "Unknown", "InterestDescription": "Placeholder interest"}
                 user_vectors = []
                 user_vectors_with_interests = []
-                user_vector_agg = []
+                user_vector_agg = np.empty(0, dtype=np.float32)
 
             print(f"Selected CustomerID from facial recognition: {customer_id}")
             if not user_vectors:
                 logger.error("No $vector found for user: %s", customer_id)
                 print("Error: No embedding vector for user")
-                return {
-                    "customer_id": customer_id,
-                    "user_interests": user_interests,
-                    "user_vectors": [],
-                    "user_vectors_with_interests": [],
-                    "user_vector_agg": [],
-                    "ad_url": state.get("ad_url", ""),
-                    "ad_url_agg": "",
-                    "product": "",
-                    "product_agg": "",
-                    "similarity_score": 0.0,
-                    "similarity_score_agg": 0.0,
-                    "play_ad": False,
-                    "play_ad_agg": False,
-                    "top_recommendations": [],
-                    "top_recommendations_agg": []
-                }
-
-            return {
-                "customer_id": customer_id,
-                "user_interests": user_interests,
-                "user_vectors": user_vectors,
-                "user_vectors_with_interests": user_vectors_with_interests,
-                "user_vector_agg": user_vector_agg,
-                "ad_url": state.get("ad_url", ""),
-                "ad_url_agg": "",
-                "product": "",
-                "product_agg": "",
-                "similarity_score": 0.0,
-                "similarity_score_agg": 0.0,
-                "play_ad": False,
-                "play_ad_agg": False,
-                "top_recommendations": [],
-                "top_recommendations_agg": []
-            }
+                return _state(state, customer_id=customer_id, user_interests=user_interests)
+
+            return _state(
+                state,
+                customer_id=customer_id,
+                user_interests=user_interests,
+                user_vectors=user_vectors,
+                user_vectors_with_interests=user_vectors_with_interests,
+                user_vector_agg=user_vector_agg
+            )
 
         else:
             logger.warning("Invalid mode choice: %s", choice)
             print("Invalid choice. Defaulting to empty CustomerID.")
-            return {
-                "customer_id": "",
-                "user_interests": {},
-                "user_vectors": [],
-                "user_vectors_with_interests": [],
-                "user_vector_agg": [],
-                "ad_url": state.get("ad_url", ""),
-                "ad_url_agg": "",
-                "product": "",
-                "product_agg": "",
-                "similarity_score": 0.0,
-                "similarity_score_agg": 0.0,
-                "play_ad": False,
-                "play_ad_agg": False,
-                "top_recommendations": [],
-                "top_recommendations_agg": []
-            }
+            return _state(state)
 
     except Exception as e:
         logger.error("Error in agent_1_node: %s", str(e))
         print(f"Error in Agent 1: {e}")
-        return {
-            "customer_id": "",
-            "user_interests": {},
-            "user_vectors": [],
-            "user_vectors_with_interests": [],
-            "user_vector_agg": [],
-            "ad_url": state.get("ad_url", ""),
-            "ad_url_agg": "",
-            "product": "",
-            "product_agg": "",
-            "similarity_score": 0.0,
-            "similarity_score_agg": 0.0,
-            "play_ad": False,
-            "play_ad_agg": False,
-            "top_recommendations": [],
-            "top_recommendations_agg": []
-        }
+        return _state(state)
+
+# Selection Approach: similarity search for a single user interest vector (cached ads or Astra DB)
+def _search_one(idx: int, user_vector: np.ndarray, interest_name: str, interest_description: str,
+                ad_cache: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> List[dict]:
+    """Return deduplicated ad recommendations for one user interest vector."""
+    logger.info("Performing similarity search for vector %s (Interest: %s, Description: %s)", 
+                idx + 1, interest_name, interest_description)
+    if ad_cache is not None:
+        top_ads = _local_top_ads(ad_cache, user_vector, limit=PER_VECTOR_SEARCH_LIMIT)
+    else:
+        advertisements_collection = _get_collection("advertisements")
+        top_ads = list(advertisements_collection.find(
+            {},
+            sort={"$vector": user_vector.tolist()},
+            limit=PER_VECTOR_SEARCH_LIMIT,
+            include_similarity=True,
+            include_sort_vector=False,
+            projection={"_id": 0, "product": 1, "video_link": 1},
+        ))
+    if not top_ads:
+        logger.warning("No advertisements found for vector %s", idx + 1)
+        return []
+
+    # Debug: Log raw data returned by similarity search
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw ads for vector %s: %s", idx + 1, top_ads)
+
+    # Deduplicate by product, keeping the highest-scoring ad per product
+    seen_products = set()
+    vector_recommendations = []
+    duplicate_count = 0
+    for ad in top_ads:
+        if not (video_link := ad.get("video_link")):
+            continue  # Skip ads without a video link
+        if (product := ad.get("product", "")) in seen_products:
+            duplicate_count += 1
+            continue  # Skip duplicates
+        vector_recommendations.append({
+            "url": video_link + _AUTOPLAY_SUFFIX,
+            "product": product,
+            "score": ad.get("$similarity", 0.0),
+            "vector_idx": idx
+        })
+        seen_products.add(product)
+    # One summary line instead of a warning per duplicate
+    if duplicate_count:
+        logger.warning("Skipped %s duplicate products in search results for vector %s", duplicate_count, idx + 1)
+
+    # Log the top recommendations for this vector
+    if vector_recommendations:
+        logger.info("Top recommendations for vector %s (Interest: %s, Description: %s):", 
+                    idx + 1, interest_name, interest_description)
+        for rec in vector_recommendations[:TOP_RECOMMENDATIONS]:  # Log up to 5 recommendations per vector
+            logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
+    return vector_recommendations
+
+# Deduplicate recommendations by a field, keeping the highest-scoring record per value
+def dedup_topk(recs: List[dict], k: Optional[int] = TOP_RECOMMENDATIONS, by: str = "product") -> List[dict]:
+    """Return the k best records (best first) after deduplicating on `by`; k=None keeps them all in input order."""
+    best = {}
+    for rec in recs:
+        if (cur := best.get(rec[by])) is None or rec["score"] > cur["score"]:
+            # Re-insert so the dict stays ordered by each winner's input position; nlargest is stable,
+            # so exact score ties then go to the earlier record, as the old stable sort did
+            best.pop(rec[by], None)
+            best[rec[by]] = rec
+    if logger.isEnabledFor(logging.DEBUG) and len(best) < len(recs):
+        logger.debug("Dropped %s records with a duplicate %s", len(recs) - len(best), by)
+    if k is None:
+        return list(best.values())
+    return heapq.nlargest(k, best.values(), key=itemgetter("score"))
+
+# Agent 2 output when no recommendation could be made (a partial state update)
+_EMPTY_AGENT_2_RESULT = dict(
+    ad_url="",
+    ad_url_agg="",
+    product="",
+    product_agg="",
+    similarity_score=0.0,
+    similarity_score_agg=0.0,
+    play_ad=False,
+    play_ad_agg=False,
+    top_recommendations=[],
+    top_recommendations_agg=[]
+)
 
 # Agent 2: Advertisement Selection Node (Astra DB Similarity Search)
 def agent_2_node(state: WorkflowState) -> WorkflowState:
-    logger.info("Starting agent_2_node with CustomerID: %s", state["customer_id"])
-    if not state["customer_id"]:
+    # Read the incoming state once; .get keeps a partially populated state from raising KeyError
+    customer_id = state.get("customer_id", "")
+    user_vectors = state.get("user_vectors") or []
+    user_vectors_with_interests = state.get("user_vectors_with_interests") or []
+    user_vector_agg = state.get("user_vector_agg", np.empty(0, dtype=np.float32))
+
+    logger.info("Starting agent_2_node with CustomerID: %s", customer_id)
+    if not customer_id:
         logger.warning("No CustomerID provided")
         print("No CustomerID provided")
-        return {
-            "customer_id": state["customer_id"],
-            "user_interests": state["user_interests"],
-            "user_vectors": state["user_vectors"],
-            "user_vectors_with_interests": state["user_vectors_with_interests"],
-            "user_vector_agg": state["user_vector_agg"],
-            "ad_url": "",
-            "ad_url_agg": "",
-            "product": "",
-            "product_agg": "",
-            "similarity_score": 0.0,
-            "similarity_score_agg": 0.0,
-            "play_ad": False,
-            "play_ad_agg": False,
-            "top_recommendations": [],
-            "top_recommendations_agg": []
-        }
+        return dict(_EMPTY_AGENT_2_RESULT)
 
-    if not state["user_vectors"]:
-        logger.warning("No user vectors available for CustomerID: %s", state["customer_id"])
+    if not user_vectors:
+        logger.warning("No user vectors available for CustomerID: %s", customer_id)
         print("Error: No user vectors available")
-        return {
-            "customer_id": state["customer_id"],
-            "user_interests": state["user_interests"],
-            "user_vectors": state["user_vectors"],
-            "user_vectors_with_interests": state["user_vectors_with_interests"],
-            "user_vector_agg": state["user_vector_agg"],
-            "ad_url": "",
-            "ad_url_agg": "",
-            "product": "",
-            "product_agg": "",
-            "similarity_score": 0.0,
-            "similarity_score_agg": 0.0,
-            "play_ad": False,
-            "play_ad_agg": False,
-            "top_recommendations": [],
-            "top_recommendations_agg": []
-        }
+        return dict(_EMPTY_AGENT_2_RESULT)
 
     try:
-        logger.debug("Connecting to Astra DB at %s", ASTRA_DB_ENDPOINT)
-        client = DataAPIClient(ASTRA_DB_TOKEN)
-        db = client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
-        advertisements_collection = db.get_collection("advertisements")
-        logger.info("Connected to advertisements collection")
+        advertisements_collection = _get_collection("advertisements")
 
-        # Debug: Log all entries in the advertisements collection
-        all_ads = list(advertisements_collection.find(
-            {},
-            projection={"product": 1, "video_link": 1, "_id": 0}
-        ))
-        logger.info("Contents of advertisements collection: %s", all_ads)
+        # Debug: Log all entries in the advertisements collection (skips the full scan unless DEBUG is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            all_ads = list(advertisements_collection.find(
+                {},
+                projection={"product": 1, "video_link": 1, "_id": 0}
+            ))
+            logger.debug("Contents of advertisements collection: %s", all_ads)
 
         # Approach 1: Selection Approach
         logger.info("Evaluating Selection Approach...")
+        # Score against the in-process ad cache when it is available
+        ad_cache = _load_ad_cache()
+        # Each search is an independent network round-trip, so run them concurrently
+        search_args = user_vectors_with_interests
         all_recommendations = []
-        for idx, (user_vector, interest_name, interest_description) in enumerate(state["user_vectors_with_interests"]):
-            logger.info("Performing similarity search for vector %s/%s (Interest: %s, Description: %s)", 
-                        idx + 1, len(state["user_vectors_with_interests"]), interest_name, interest_description)
-            top_ads = list(advertisements_collection.find(
-                {},
-                sort={"$vector": user_vector},
-                limit=10,
-                include_similarity=True,
-                projection={"product": 1, "video_link": 1},
-            ))
-            if not top_ads:
-                logger.warning("No advertisements found for vector %s", idx + 1)
-                continue
-
-            # Debug: Log raw data returned by similarity search
-            logger.debug("Raw ads for vector %s: %s", idx + 1, top_ads)
-
-            # Deduplicate by product, keeping the highest-scoring ad per product
-            seen_products = set()
-            vector_recommendations = []
-            for ad in top_ads:
-                product = ad.get("product", "")
-                if product in seen_products:
-                    logger.warning("Duplicate product found in search results for vector %s: %s", idx + 1, product)
-                    continue  # Skip duplicates
-                ad_url = ad.get("video_link", "") + "&autoplay=1&mute=1" if ad.get("video_link") else ""
-                if ad_url:
-                    vector_recommendations.append({
-                        "url": ad_url,
-                        "product": product,
-                        "score": ad.get("$similarity", 0.0),
-                        "vector_idx": idx
-                    })
-                    seen_products.add(product)
-
-            # Log the top recommendations for this vector
-            if vector_recommendations:
-                logger.info("Top recommendations for vector %s (Interest: %s, Description: %s):", 
-                            idx + 1, interest_name, interest_description)
-                for rec in vector_recommendations[:5]:  # Log up to 5 recommendations per vector
-                    logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-                all_recommendations.extend(vector_recommendations)
-
+        if search_args:
+            with ThreadPoolExecutor(max_workers=min(len(search_args), MAX_SEARCH_WORKERS)) as executor:
+                results = executor.map(
+                    lambda item: _search_one(item[0], *item[1], ad_cache),
+                    enumerate(search_args)
+                )
+                all_recommendations = [rec for vector_recommendations in results for rec in vector_recommendations]
+
+        # Defaults for when the Selection Approach finds nothing
+        ad_url = ""
+        product = ""
+        similarity_score = 0.0
+        top_recommendations = []
         if not all_recommendations:
             logger.error("No advertisements found across all vectors (Selection Approach)")
             print("Error: No advertisements found (Selection Approach)")
             # Proceed to Aggregation Approach
         else:
             # Deduplicate by product across all recommendations, keeping the highest-scoring ad per product
-            seen_products = set()
-            deduplicated_recommendations = []
-            # Sort by score to ensure highest-scoring ad per product is kept
-            all_recommendations.sort(key=lambda x: x["score"], reverse=True)
-            for rec in all_recommendations:
-                product = rec["product"]
-                if product in seen_products:
-                    logger.warning("Duplicate product found across all recommendations: %s", product)
-                    continue  # Skip duplicates
-                deduplicated_recommendations.append(rec)
-                seen_products.add(product)
+            deduplicated_recommendations = dedup_topk(all_recommendations, k=None, by="product")
 
             # Log all deduplicated recommendations
-            logger.debug("Deduplicated recommendations (Selection Approach): %s", deduplicated_recommendations)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Deduplicated recommendations (Selection Approach): %s", deduplicated_recommendations)
+
+            # Deduplicate by URL the same way and take the top 5 without sorting the full list;
+            # the overall best ad is also the best for its URL, so it always leads
+            top5 = dedup_topk(deduplicated_recommendations, by="url")
 
-            # Sort deduplicated recommendations by score and select the top match
-            deduplicated_recommendations.sort(key=lambda x: x["score"], reverse=True)
-            top_match = deduplicated_recommendations[0]
+            top_match = top5[0]
             ad_url = top_match["url"]
             product = top_match["product"]
             similarity_score = top_match["score"]
             logger.info("Top advertisement (vector %s, Selection Approach): %s, Product: %s, Similarity Score: %s", 
                         top_match["vector_idx"] + 1, ad_url, product, similarity_score)
 
-            # Prepare top 5 recommendations (deduplicated by URL, ensuring top ad is included)
-            seen_urls = set()
-            top_recommendations = [{
-                "url": top_match["url"],
-                "product": top_match["product"],
-                "score": top_match["score"]
-            }]
-            seen_urls.add(top_match["url"])
-
-            # Add remaining recommendations, up to 5
-            for rec in deduplicated_recommendations[1:]:
-                if rec["url"] not in seen_urls and len(top_recommendations) < 5:
-                    top_recommendations.append({
-                        "url": rec["url"],
-                        "product": rec["product"],
-                        "score": rec["score"]
-                    })
-                    seen_urls.add(rec["url"])
+            top_recommendations = [
+                {"url": rec["url"], "product": rec["product"], "score": rec["score"]}
+                for rec in top5
+            ]
 
             logger.info("Top 5 aggregated recommendations (Selection Approach):")
             for rec in top_recommendations:
                 logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-        # Set default values if Selection Approach fails
-        if not all_recommendations:
-            ad_url = ""
-            product = ""
-            similarity_score = 0.0
-            top_recommendations = []
 
         # Approach 2: Aggregation Approach
         logger.info("Evaluating Aggregation Approach...")
-        if not state["user_vector_agg"]:
-            logger.warning("No aggregated user vector available for CustomerID: %s", state["customer_id"])
+        if len(user_vector_agg) == 0:
+            logger.warning("No aggregated user vector available for CustomerID: %s", customer_id)
             ad_url_agg = ""
             product_agg = ""
             similarity_score_agg = 0.0
@@ -652,10 +630,11 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
             # Perform similarity search with the aggregated vector
             top_ads_agg = list(advertisements_collection.find(
                 {},
-                sort={"$vector": state["user_vector_agg"]},
+                sort={"$vector": user_vector_agg.tolist()},
                 limit=10,
                 include_similarity=True,
-                projection={"product": 1, "video_link": 1},
+                include_sort_vector=False,
+                projection={"_id": 0, "product": 1, "video_link": 1},
             ))
             if not top_ads_agg:
                 logger.warning("No advertisements found for aggregated vector")
@@ -665,58 +644,41 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
                 top_recommendations_agg = []
             else:
                 # Debug: Log raw data returned by similarity search
-                logger.debug("Raw ads for aggregated vector: %s", top_ads_agg)
-
-                # Deduplicate by product, keeping the highest-scoring ad per product
-                seen_products_agg = set()
-                agg_recommendations = []
-                for ad in top_ads_agg:
-                    product = ad.get("product", "")
-                    if product in seen_products_agg:
-                        logger.warning("Duplicate product found in aggregated search results: %s", product)
-                        continue  # Skip duplicates
-                    ad_url = ad.get("video_link", "") + "&autoplay=1&mute=1" if ad.get("video_link") else ""
-                    if ad_url:
-                        agg_recommendations.append({
-                            "url": ad_url,
-                            "product": product,
-                            "score": ad.get("$similarity", 0.0),
-                            "vector_idx": -1  # Not applicable for aggregated vector
-                        })
-                        seen_products_agg.add(product)
-
-                if not agg_recommendations:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Raw ads for aggregated vector: %s", top_ads_agg)
+
+                # Deduplicate by product, then by URL, keeping the highest-scoring ad each time
+                agg_recommendations = [
+                    {
+                        "url": video_link + _AUTOPLAY_SUFFIX,
+                        "product": ad.get("product", ""),
+                        "score": ad.get("$similarity", 0.0),
+                        "vector_idx": -1  # Not applicable for aggregated vector
+                    }
+                    for ad in top_ads_agg
+                    if (video_link := ad.get("video_link"))  # Skip ads without a video link
+                ]
+                top5_agg = dedup_topk(dedup_topk(agg_recommendations, k=None, by="product"), by="url")
+
+                if not top5_agg:
                     logger.error("No advertisements found for aggregated vector")
                     ad_url_agg = ""
                     product_agg = ""
                     similarity_score_agg = 0.0
                     top_recommendations_agg = []
                 else:
-                    # Log recommendations for the aggregated vector
-                    logger.info("Top recommendations for aggregated vector (Aggregation Approach):")
-                    for rec in agg_recommendations[:5]:
-                        logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-
-                    # Sort and select top match for aggregated approach
-                    agg_recommendations.sort(key=lambda x: x["score"], reverse=True)
-                    top_match_agg = agg_recommendations[0]
+                    # Select top match for aggregated approach
+                    top_match_agg = top5_agg[0]
                     ad_url_agg = top_match_agg["url"]
                     product_agg = top_match_agg["product"]
                     similarity_score_agg = top_match_agg["score"]
                     logger.info("Top advertisement (Aggregation Approach): %s, Product: %s, Similarity Score: %s", 
                                 ad_url_agg, product_agg, similarity_score_agg)
 
-                    # Prepare top 5 recommendations for aggregated approach (deduplicated by URL)
-                    seen_urls_agg = set()
-                    top_recommendations_agg = []
-                    for rec in agg_recommendations:
-                        if rec["url"] not in seen_urls_agg and len(top_recommendations_agg) < 5:
-                            top_recommendations_agg.append({
-                                "url": rec["url"],
-                                "product": rec["product"],
-                                "score": rec["score"]
-                            })
-                            seen_urls_agg.add(rec["url"])
+                    top_recommendations_agg = [
+                        {"url": rec["url"], "product": rec["product"], "score": rec["score"]}
+                        for rec in top5_agg
+                    ]
 
                     logger.info("Top 5 recommendations (Aggregation Approach):")
                     for rec in top_recommendations_agg:
@@ -724,20 +686,16 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
 
         # Compare the two approaches
         logger.info("Comparison of Selection vs Aggregation Approach:")
-        logger.info("Selection Approach - Top Ad: %s, Product: %s, Score: %s", top_match["url"], top_match["product"], top_match["score"])
+        logger.info("Selection Approach - Top Ad: %s, Product: %s, Score: %s", ad_url, product, similarity_score)
         logger.info("Aggregation Approach - Top Ad: %s, Product: %s, Score: %s", ad_url_agg, product_agg, similarity_score_agg)
 
+        # Return only the keys this node writes; LangGraph merges them into the existing state
         return {
-            "customer_id": state["customer_id"],
-            "user_interests": state["user_interests"],
-            "user_vectors": state["user_vectors"],
-            "user_vectors_with_interests": state["user_vectors_with_interests"],
-            "user_vector_agg": state["user_vector_agg"],
-            "ad_url": top_match["url"],
+            "ad_url": ad_url,
             "ad_url_agg": ad_url_agg,
-            "product": top_match["product"],
+            "product": product,
             "product_agg": product_agg,
-            "similarity_score": top_match["score"],
+            "similarity_score": similarity_score,
             "similarity_score_agg": similarity_score_agg,
             "play_ad": False,  # Agent 3 will decide for Selection Approach
             "play_ad_agg": False,  # Agent 3 will decide for Aggregation Approach
@@ -746,25 +704,8 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
         }
 
     except Exception as e:
-        logger.error("Error in agent_2_node: %s", str(e))
-        print(f"Error in Agent 2: {e}")
-        return {
-            "customer_id": state["customer_id"],
-            "user_interests": state["user_interests"],
-            "user_vectors": state["user_vectors"],
-            "user_vectors_with_interests": state["user_vectors_with_interests"],
-            "user_vector_agg": state["user_vector_agg"],
-            "ad_url": "",
-            "ad_url_agg": "",
-            "product": "",
-            "product_agg": "",
-            "similarity_score": 0.0,
-            "similarity_score_agg": 0.0,
-            "play_ad": False,
-            "play_ad_agg": False,
-            "top_recommendations": [],
-            "top_recommendations_agg": []
-        }
+        logger.exception("Error in agent_2_node: %s", str(e))
+        return dict(_EMPTY_AGENT_2_RESULT)
 
 # Agent 3: Similarity Score Validation Node
 def agent_3_node(state: WorkflowState) -> WorkflowState:
@@ -773,6 +714,9 @@ def agent_3_node(state: WorkflowState) -> WorkflowState:
     DEFAULT_AD_URL = "https://www.youtube.com/watch?v=default_ad&autoplay=1&mute=1"
     DEFAULT_PRODUCT = "Generic Product"
 
+    ad_url, product = state["ad_url"], state["product"]
+    ad_url_agg, product_agg = state["ad_url_agg"], state["product_agg"]
+
     # Validate Selection Approach
     if state["similarity_score"] >= SIMILARITY_THRESHOLD:
         logger.info(
@@ -787,8 +731,7 @@ def agent_3_node(state: WorkflowState) -> WorkflowState:
         )
         print(f"Warning: Low similarity score ({state['similarity_score']}) for product: {state['product']} (Selection Approach)")
         play_ad = False
-        state["ad_url"] = DEFAULT_AD_URL
-        state["product"] = DEFAULT_PRODUCT
+        ad_url, product = DEFAULT_AD_URL, DEFAULT_PRODUCT
 
     # Validate Aggregation Approach
     if state["similarity_score_agg"] >= SIMILARITY_THRESHOLD:
@@ -804,37 +747,24 @@ def agent_3_node(state: WorkflowState) -> WorkflowState:
         )
         print(f"Warning: Low similarity score ({state['similarity_score_agg']}) for product: {state['product_agg']} (Aggregation Approach)")
         play_ad_agg = False
-        state["ad_url_agg"] = DEFAULT_AD_URL
-        state["product_agg"] = DEFAULT_PRODUCT
+        ad_url_agg, product_agg = DEFAULT_AD_URL, DEFAULT_PRODUCT
 
+    # Return only the keys this node decides; LangGraph merges them into the existing state
     return {
-        "customer_id": state["customer_id"],
-        "user_interests": state["user_interests"],
-        "user_vectors": state["user_vectors"],
-        "user_vectors_with_interests": state["user_vectors_with_interests"],
-        "user_vector_agg": state["user_vector_agg"],
-        "ad_url": state["ad_url"],
-        "ad_url_agg": state["ad_url_agg"],
-        "product": state["product"],
-        "product_agg": state["product_agg"],
-        "similarity_score": state["similarity_score"],
-        "similarity_score_agg": state["similarity_score_agg"],
+        "ad_url": ad_url,
+        "ad_url_agg": ad_url_agg,
+        "product": product,
+        "product_agg": product_agg,
         "play_ad": play_ad,
-        "play_ad_agg": play_ad_agg,
-        "top_recommendations": state["top_recommendations"],
-        "top_recommendations_agg": state["top_recommendations_agg"]
+        "play_ad_agg": play_ad_agg
     }
 
 # Error Handler Node
 def error_handler_node(state: WorkflowState) -> WorkflowState:
     logger.error("Error handler triggered: No valid CustomerID or URL found")
     print("Error: No valid CustomerID or URL found")
+    # Return only the keys this node resets; LangGraph merges them into the existing state
     return {
-        "customer_id": state["customer_id"],
-        "user_interests": state["user_interests"],
-        "user_vectors": state["user_vectors"],
-        "user_vectors_with_interests": state["user_vectors_with_interests"],
-        "user_vector_agg": state["user_vector_agg"],
         "ad_url": "https://www.youtube.com/watch?v=default_video&autoplay=1&mute=1",
         "ad_url_agg": "https://www.youtube.com/watch?v=default_video&autoplay=1&mute=1",
         "product": "",
@@ -847,34 +777,39 @@ def error_handler_node(state: WorkflowState) -> WorkflowState:
         "top_recommendations_agg": []
     }
 
-# Build the LangGraph workflow
-workflow = StateGraph(WorkflowState)
-workflow.add_node("agent_1", agent_1_node)
-workflow.add_node("agent_2", agent_2_node)
-workflow.add_node("agent_3", agent_3_node)
-workflow.add_node("error_handler", error_handler_node)
-
-workflow.add_edge(START, "agent_1")
-workflow.add_conditional_edges(
-    "agent_1",
-    lambda state: "agent_2" if state["customer_id"] else "error_handler"
-)
-workflow.add_edge("agent_2", "agent_3")
-workflow.add_edge("agent_3", END)
-workflow.add_edge("error_handler", END)
-
-# Compile the graph
-graph = workflow.compile()
+# Build the LangGraph workflow (langgraph is imported here so importing this module stays cheap)
+def build_graph():
+    """Build and compile the agent workflow graph."""
+    from langgraph.graph import StateGraph, START, END
+
+    workflow = StateGraph(WorkflowState)
+    workflow.add_node("agent_1", agent_1_node)
+    workflow.add_node("agent_2", agent_2_node)
+    workflow.add_node("agent_3", agent_3_node)
+    workflow.add_node("error_handler", error_handler_node)
+
+    workflow.add_edge(START, "agent_1")
+    workflow.add_conditional_edges(
+        "agent_1",
+        lambda state: "agent_2" if state["customer_id"] else "error_handler"
+    )
+    workflow.add_edge("agent_2", "agent_3")
+    workflow.add_edge("agent_3", END)
+    workflow.add_edge("error_handler", END)
+
+    # Compile the graph
+    return workflow.compile()
 
 # Main execution
 def main():
     logger.info("Starting recommendation workflow")
+    graph = build_graph()
     result = graph.invoke({
         "customer_id": "",
         "user_interests": {},
         "user_vectors": [],
         "user_vectors_with_interests": [],
-        "user_vector_agg": [],
+        "user_vector_agg": np.empty(0, dtype=np.float32),
         "ad_url": "",
         "ad_url_agg": "",
         "product": "",
@@ -1,7 +1,16 @@
 import os
+import sys
+import asyncio
 import logging
+import numpy as np
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from heapq import merge
+from dataclasses import dataclass
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from typing import List, Dict, Tuple
 from astrapy import DataAPIClient
 from dotenv import load_dotenv
@@ -29,6 +38,19 @@ ASTRA_DB_TOKEN = os.getenv("ASTRA_DB_TOKEN")
 USERINTERESTS_COLLECTION = os.getenv("USERINTERESTS_COLLECTION", "userinterests")
 ADVERTISEMENTS_COLLECTION = os.getenv("ADVERTISEMENTS_COLLECTION", "advertisements")
 
+# Full responses are memoized per UserId for this long (seconds), for at most this many users
+RECOMMENDATION_CACHE_TTL_SECONDS = float(os.getenv("RECOMMENDATION_CACHE_TTL_SECONDS", "60"))
+RECOMMENDATION_CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", "10000"))
+
+# The in-process ad catalog is reloaded in the background this often (seconds)
+AD_CACHE_TTL_SECONDS = float(os.getenv("AD_CACHE_TTL_SECONDS", "300"))
+
+# Most UserIds accepted by one batch recommendation request
+MAX_BATCH_USERS = int(os.getenv("MAX_BATCH_USERS", "100"))
+
+# Query string appended to every ad video link so it autoplays muted
+_AUTOPLAY_SUFFIX = "&autoplay=1&mute=1"
+
 if not ASTRA_DB_ENDPOINT or not ASTRA_DB_TOKEN:
     logger.error("Missing required environment variables: ASTRA_DB_ENDPOINT or ASTRA_DB_TOKEN")
     raise ValueError("Missing required environment variables: ASTRA_DB_ENDPOINT or ASTRA_DB_TOKEN")
@@ -37,44 +59,116 @@ logger.info("Environment variables loaded")
 logger.debug("ASTRA_DB_ENDPOINT: %s", ASTRA_DB_ENDPOINT)
 logger.debug("ASTRA_DB_TOKEN: %s", ASTRA_DB_TOKEN)
 
+# Startup work runs in the app lifespan, before the first request is served; on shutdown the
+# database and collection handles are exited, which closes the HTTP client each one owns
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with db, userinterests_collection, advertisements_collection:
+        await load_advertisement_cache()
+        refresh_task = asyncio.create_task(refresh_advertisement_cache())
+        yield
+        refresh_task.cancel()
+        await asyncio.gather(refresh_task, return_exceptions=True)
+
 # FastAPI app
-app = FastAPI(title="Recommendation API", description="API for generating product recommendations using Astra DB", version="7.0")
+app = FastAPI(title="Recommendation API", description="API for generating product recommendations using Astra DB", version="7.0",
+              default_response_class=ORJSONResponse, lifespan=lifespan)
 
-# Pydantic models for response
+# Pydantic models for response; instances are built with model_construct from trusted data
 class Recommendation(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
     url: str
     product: str
     score: float
 
 class SelectionApproachResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
     top_ad: Recommendation
     top_recommendations: List[Recommendation]
 
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[str]
+
 class RecommendationResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
     customer_id: str
     user_interests: Dict[str, str]
     selection_approach: SelectionApproachResponse
 
-# Initialize Astra DB client
+# Internal recommendation record; slots keep it small and make attribute access cheap
+@dataclass(slots=True)
+class Rec:
+    url: str
+    product: str
+    score: float
+    vector_idx: int
+
+# Initialize Astra DB client; one shared async database, so every endpoint awaits its queries
+# on the event loop instead of blocking it, and concurrent searches reuse the same client
 client = DataAPIClient(ASTRA_DB_TOKEN)
-db = client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
+db = client.get_async_database(ASTRA_DB_ENDPOINT)
 userinterests_collection = db.get_collection(USERINTERESTS_COLLECTION)
 advertisements_collection = db.get_collection(ADVERTISEMENTS_COLLECTION)
 
-def get_user_data(user_id: str) -> Tuple[str, dict, list]:
-    """Retrieve user data (ID, interests, vectors with interest details) for the specified UserId."""
-    logger.info("Fetching data for specified UserId: %s", user_id)
-    entries = list(userinterests_collection.find(
-        {"UserId": user_id},
-        projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-    ))
-    if not entries:
-        logger.error("No entries found for UserId: %s", user_id)
-        raise HTTPException(status_code=404, detail=f"No entries found for UserId: {user_id}")
+# In-process copy of the advertisement catalog (one L2-normalized row per ad), loaded at startup
+# and reloaded every AD_CACHE_TTL_SECONDS; the three globals are swapped together with no await between them
+ad_vectors = None
+ad_products = []
+ad_video_links = []
 
-    customer_id = user_id
-    logger.info("Found entries for UserId: %s", customer_id)
+async def load_advertisement_cache():
+    """Load all advertisement vectors and metadata so similarity can be scored locally."""
+    global ad_vectors, ad_products, ad_video_links
+    try:
+        ads = [ad async for ad in advertisements_collection.find(
+            {},
+            projection={"_id": 0, "product": 1, "video_link": 1, "$vector": 1}
+        ) if ad.get("$vector")]
+        if not ads:
+            logger.warning("No advertisement vectors available, using Astra DB similarity search")
+            return
+        vectors = np.asarray([ad["$vector"] for ad in ads], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        ad_products = [ad.get("product", "") for ad in ads]
+        ad_video_links = [ad.get("video_link", "") for ad in ads]
+        ad_vectors = vectors
+        # Memoized responses were scored against the previous catalog
+        recommendation_cache.clear()
+        logger.info("Loaded %s advertisements into the in-process cache", len(ads))
+    except Exception as e:
+        logger.warning("Failed to load advertisement cache: %s, using Astra DB similarity search", str(e))
+
+async def refresh_advertisement_cache():
+    """Reload the advertisement cache every AD_CACHE_TTL_SECONDS, off the request path."""
+    while True:
+        await asyncio.sleep(AD_CACHE_TTL_SECONDS)
+        await load_advertisement_cache()
+
+def local_top_ads(user_vectors: List[List[float]], limit: int) -> List[List[Dict]]:
+    """Score user vectors against the cached ads in one matrix product and return each one's top matches, best first."""
+    queries = np.asarray(user_vectors, dtype=np.float32)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    queries /= norms
+    # Astra reports cosine similarity rescaled to [0, 1] as (1 + cos) / 2; keep the same scale
+    scores = (queries @ ad_vectors.T + 1.0) * 0.5
+    # Partial selection of the top k per row (O(M)), then sort only those k
+    k = min(limit, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    return [
+        [
+            {"product": ad_products[i], "video_link": ad_video_links[i], "$similarity": float(row_scores[i])}
+            for i in row_top
+        ]
+        for row_top, row_scores in zip(top, scores)
+    ]
 
+def build_user_data(entries: list) -> Tuple[dict, list]:
+    """Build the joined interests and (vector, InterestName, InterestDescription) tuples from a user's entries."""
     user_interests = {
         "InterestName": ", ".join(set(entry.get("InterestName", "") for entry in entries)),
         "InterestDescription": ", ".join(set(entry.get("InterestDescription", "") for entry in entries))
@@ -83,134 +177,250 @@ def get_user_data(user_id: str) -> Tuple[str, dict, list]:
         (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
         for entry in entries if entry.get("$vector", [])
     ]
+    return user_interests, user_vectors_with_interests
+
+async def get_user_data(user_id: str) -> Tuple[str, dict, list]:
+    """Retrieve user data (ID, interests, vectors with interest details) for the specified UserId."""
+    logger.info("Fetching data for specified UserId: %s", user_id)
+    entries = await userinterests_collection.find(
+        {"UserId": user_id},
+        projection={"_id": 0, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
+    ).to_list()
+    if not entries:
+        logger.error("No entries found for UserId: %s", user_id)
+        raise HTTPException(status_code=404, detail=f"No entries found for UserId: {user_id}")
+
+    customer_id = user_id
+    logger.info("Found entries for UserId: %s", customer_id)
+
+    user_interests, user_vectors_with_interests = build_user_data(entries)
     if not user_vectors_with_interests:
         logger.error("No valid $vector found for UserId: %s", customer_id)
         raise HTTPException(status_code=400, detail=f"No valid $vector found for UserId: {customer_id}")
 
     return customer_id, user_interests, user_vectors_with_interests
 
-def perform_selection_approach(user_vectors_with_interests: List[Tuple[List[float], str, str]]) -> List[Dict]:
-    """Perform the Selection Approach for recommendation."""
+async def get_users_data(user_ids: List[str]) -> Dict[str, Tuple[dict, list]]:
+    """Retrieve user data for several UserIds in one $in query; users without entries or vectors are left out."""
+    logger.info("Fetching data for %s UserIds", len(user_ids))
+    entries = await userinterests_collection.find(
+        {"UserId": {"$in": user_ids}},
+        projection={"_id": 0, "UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
+    ).to_list()
+    grouped = defaultdict(list)
+    for entry in entries:
+        grouped[entry.get("UserId")].append(entry)
+
+    users_data = {}
+    for user_id in user_ids:
+        if user_id not in grouped:
+            logger.warning("No entries found for UserId: %s", user_id)
+            continue
+        user_interests, user_vectors_with_interests = build_user_data(grouped[user_id])
+        if not user_vectors_with_interests:
+            logger.warning("No valid $vector found for UserId: %s", user_id)
+            continue
+        users_data[user_id] = (user_interests, user_vectors_with_interests)
+    return users_data
+
+def product_name(ad: dict) -> str:
+    """Return the ad's product as an interned str; a missing or null product becomes "" and other values are stringified."""
+    product = ad.get("product")
+    if product is None:
+        return ""
+    return sys.intern(product if isinstance(product, str) else str(product))
+
+async def perform_selection_approach(user_vectors_with_interests: List[Tuple[List[float], str, str]]) -> List[List[Rec]]:
+    """Perform the Selection Approach for recommendation, returning each vector's recommendations best first."""
     logger.info("Evaluating Selection Approach...")
-    all_recommendations = []
-    for idx, (user_vector, interest_name, interest_description) in enumerate(user_vectors_with_interests):
+    for idx, (_, interest_name, interest_description) in enumerate(user_vectors_with_interests):
         logger.info("Performing similarity search for vector %s/%s (Interest: %s, Description: %s)", 
                     idx + 1, len(user_vectors_with_interests), interest_name, interest_description)
-        top_ads = list(advertisements_collection.find(
-            {},
-            sort={"$vector": user_vector},
-            limit=10,
-            include_similarity=True,
-            projection={"product": 1, "video_link": 1},
+
+    # The Data API has no multi-vector search, so batch what we can: send each distinct vector
+    # only once, issue those searches all at once, and fan the results back out per interest
+    distinct_vectors = {}
+    for user_vector, _, _ in user_vectors_with_interests:
+        distinct_vectors.setdefault(tuple(user_vector), user_vector)
+    if ad_vectors is not None:
+        # Score every distinct vector against the in-process ad cache at once, no round-trips
+        search_results = local_top_ads(list(distinct_vectors.values()), limit=10)
+    else:
+        search_results = await asyncio.gather(*(
+            advertisements_collection.find(
+                {},
+                sort={"$vector": user_vector},
+                limit=10,
+                include_similarity=True,
+                include_sort_vector=False,
+                projection={"_id": 0, "product": 1, "video_link": 1},
+            ).to_list()
+            for user_vector in distinct_vectors.values()
         ))
+    results_by_vector = dict(zip(distinct_vectors, search_results))
+
+    per_vector_recommendations = []
+    for idx, (user_vector, interest_name, interest_description) in enumerate(user_vectors_with_interests):
+        top_ads = results_by_vector[tuple(user_vector)]
         if not top_ads:
             logger.warning("No advertisements found for vector %s", idx + 1)
             continue
 
-        seen_products = set()
-        vector_recommendations = []
-        for ad in top_ads:
-            product = ad.get("product", "")
-            if product in seen_products:
-                logger.warning("Duplicate product found in search results for vector %s: %s", idx + 1, product)
-                continue
-            ad_url = ad.get("video_link", "") + "&autoplay=1&mute=1" if ad.get("video_link") else ""
-            if ad_url:
-                vector_recommendations.append({
-                    "url": ad_url,
-                    "product": product,
-                    "score": ad.get("$similarity", 0.0),
-                    "vector_idx": idx
-                })
-                seen_products.add(product)
+        # No per-vector product dedup: select_top_recommendation deduplicates once across all vectors,
+        # and the best record of a product within a vector is also the first it sees
+        vector_recommendations = [
+            Rec(
+                url=video_link + _AUTOPLAY_SUFFIX,
+                # Product names repeat across vectors and requests; intern them so they share one object
+                product=product_name(ad),
+                score=ad.get("$similarity", 0.0),
+                vector_idx=idx
+            )
+            for ad in top_ads
+            if (video_link := ad.get("video_link"))
+        ]
 
         if vector_recommendations:
             logger.info("Top recommendations for vector %s (Interest: %s, Description: %s):", 
                         idx + 1, interest_name, interest_description)
             for rec in vector_recommendations[:5]:
-                logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-        all_recommendations.extend(vector_recommendations)
+                logger.info("  - URL: %s, Product: %s, Score: %s", rec.url, rec.product, rec.score)
+        # Search results come back best first, so each vector's list is already sorted by rank
+        per_vector_recommendations.append(vector_recommendations)
 
-    if not all_recommendations:
+    if not any(per_vector_recommendations):
         logger.error("No advertisements found across all vectors (Selection Approach)")
         raise HTTPException(status_code=404, detail="No advertisements found across all vectors (Selection Approach)")
 
-    return all_recommendations
+    return per_vector_recommendations
+
+def recommendation_rank(rec: Rec) -> Tuple[float, int]:
+    """Ranking key for recommendations: highest score first, earlier interest vector on ties."""
+    return rec.score, -rec.vector_idx
 
-def select_top_recommendation(all_recommendations: List[Dict]) -> Dict:
+def select_top_recommendation(per_vector_recommendations: List[List[Rec]]) -> SelectionApproachResponse:
     """Select the highest-scoring ad and top 5 recommendations after deduplication."""
+    # k-way merge of the per-vector lists yields recommendations best first without building or
+    # sorting a combined list. The first record seen per product is its best one; keeping the
+    # first of those per URL and stopping at five gives the deduplicated top 5
     seen_products = set()
-    deduplicated_recommendations = []
-    all_recommendations.sort(key=lambda x: (x["score"], -x["vector_idx"]), reverse=True)
-    for rec in all_recommendations:
-        product = rec["product"]
-        if product in seen_products:
-            logger.warning("Duplicate product found across all recommendations: %s", product)
+    seen_urls = set()
+    top5 = []
+    for rec in merge(*per_vector_recommendations, key=recommendation_rank, reverse=True):
+        if rec.product in seen_products:
             continue
-        deduplicated_recommendations.append(rec)
-        seen_products.add(product)
+        seen_products.add(rec.product)
+        if rec.url in seen_urls:
+            continue
+        seen_urls.add(rec.url)
+        top5.append(rec)
+        if len(top5) == 5:
+            break
 
-    top_match = deduplicated_recommendations[0]
+    top_match = top5[0]
     logger.info("Top advertisement (vector %s, Selection Approach): %s, Product: %s, Similarity Score: %s", 
-                top_match["vector_idx"] + 1, top_match["url"], top_match["product"], top_match["score"])
-
-    seen_urls = set()
-    top_recommendations = [{
-        "url": top_match["url"],
-        "product": top_match["product"],
-        "score": top_match["score"]
-    }]
-    seen_urls.add(top_match["url"])
-
-    for rec in deduplicated_recommendations[1:]:
-        if rec["url"] not in seen_urls and len(top_recommendations) < 5:
-            top_recommendations.append({
-                "url": rec["url"],
-                "product": rec["product"],
-                "score": rec["score"]
-            })
-            seen_urls.add(rec["url"])
+                top_match.vector_idx + 1, top_match.url, top_match.product, top_match.score)
 
     logger.info("Top 5 aggregated recommendations (Selection Approach):")
-    for rec in top_recommendations:
-        logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-
-    return {
-        "top_ad": {
-            "url": top_match["url"],
-            "product": top_match["product"],
-            "score": top_match["score"]
-        },
-        "top_recommendations": top_recommendations
-    }
+    for rec in top5:
+        logger.info("  - URL: %s, Product: %s, Score: %s", rec.url, rec.product, rec.score)
+
+    # Convert to response models once, at the API boundary; the fields are already the right
+    # types, so model_construct skips re-validating them
+    top_recommendations = [
+        Recommendation.model_construct(url=rec.url, product=rec.product, score=rec.score)
+        for rec in top5
+    ]
+    return SelectionApproachResponse.model_construct(
+        top_ad=top_recommendations[0],
+        top_recommendations=top_recommendations
+    )
+
+# Recently generated responses, keyed by UserId
+recommendation_cache = TTLCache(maxsize=RECOMMENDATION_CACHE_SIZE, ttl=RECOMMENDATION_CACHE_TTL_SECONDS)
+
+async def build_recommendation_response(customer_id: str, user_interests: dict, user_vectors_with_interests: list) -> Dict:
+    """Run the Selection Approach for one user and return (and cache) the response content."""
+    per_vector_recommendations = await perform_selection_approach(user_vectors_with_interests)
+    selection_result = select_top_recommendation(per_vector_recommendations)
+
+    # Build the response content once; returning a Response directly skips FastAPI's second
+    # validation and serialization pass (response_model still documents the schema)
+    response = RecommendationResponse.model_construct(
+        customer_id=customer_id,
+        user_interests=user_interests,
+        selection_approach=selection_result
+    ).model_dump()
+    recommendation_cache[customer_id] = response
+    return response
 
 @app.get("/recommend/{user_id}", response_model=RecommendationResponse)
 async def get_recommendations(user_id: str):
     """API endpoint to get product recommendations for a specified UserId using the Selection Approach."""
     try:
         logger.info("Received request for recommendations for UserId: %s", user_id)
+        cached_response = recommendation_cache.get(user_id)
+        if cached_response is not None:
+            logger.info("Serving cached recommendations for UserId: %s", user_id)
+            return ORJSONResponse(content=cached_response)
 
         # Step 1: Retrieve user data
-        customer_id, user_interests, user_vectors_with_interests = get_user_data(user_id)
-
-        # Step 2: Perform Selection Approach
-        all_recommendations = perform_selection_approach(user_vectors_with_interests)
-
-        # Step 3: Select top recommendation
-        selection_result = select_top_recommendation(all_recommendations)
+        customer_id, user_interests, user_vectors_with_interests = await get_user_data(user_id)
 
-        # Construct the response
-        response = {
-            "customer_id": customer_id,
-            "user_interests": user_interests,
-            "selection_approach": selection_result
-        }
+        # Steps 2-3: Perform Selection Approach and build the response
+        response = await build_recommendation_response(customer_id, user_interests, user_vectors_with_interests)
         logger.info("Successfully generated recommendations for UserId: %s", user_id)
-        return response
+        return ORJSONResponse(content=response)
 
     except HTTPException as e:
         logger.error("HTTP error: %s", str(e))
         raise
     except Exception as e:
         logger.error("Error in recommendation process: %s", str(e))
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+@app.post("/recommend/batch", response_model=List[RecommendationResponse])
+async def get_batch_recommendations(request: BatchRecommendationRequest):
+    """API endpoint to get recommendations for several UserIds, fetching all their interests in one query."""
+    try:
+        user_ids = list(dict.fromkeys(request.user_ids))  # Drop repeats, keep request order
+        logger.info("Received batch request for recommendations for %s UserIds", len(user_ids))
+        if len(user_ids) > MAX_BATCH_USERS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_USERS} UserIds per batch request")
+
+        responses = {}
+        for user_id in user_ids:
+            cached_response = recommendation_cache.get(user_id)
+            if cached_response is not None:
+                responses[user_id] = cached_response
+
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in responses]
+        if missing_user_ids:
+            users_data = await get_users_data(missing_user_ids)
+            results = await asyncio.gather(*(
+                build_recommendation_response(user_id, user_interests, user_vectors_with_interests)
+                for user_id, (user_interests, user_vectors_with_interests) in users_data.items()
+            ), return_exceptions=True)
+            for user_id, result in zip(users_data, results):
+                if isinstance(result, HTTPException):
+                    logger.warning("No recommendations for UserId %s: %s", user_id, result.detail)
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                responses[user_id] = result
+
+        logger.info("Successfully generated recommendations for %s of %s UserIds", len(responses), len(user_ids))
+        return ORJSONResponse(content=[responses[user_id] for user_id in user_ids if user_id in responses])
+
+    except HTTPException as e:
+        logger.error("HTTP error: %s", str(e))
+        raise
+    except Exception as e:
+        logger.error("Error in batch recommendation process: %s", str(e))
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+@app.delete("/recommend/{user_id}", status_code=204)
+async def invalidate_recommendations(user_id: str):
+    """API endpoint to drop the cached recommendations for a UserId so the next request recomputes them."""
+    recommendation_cache.pop(user_id, None)
+    logger.info("Invalidated cached recommendations for UserId: %s", user_id)
\ No newline at end of file
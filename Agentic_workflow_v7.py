@@ -1,22 +1,36 @@
 import os
+import asyncio
+import queue
+import atexit
 import logging
+import logging.handlers
+import numpy as np
+from contextlib import asynccontextmanager
+from heapq import heapify, heappop
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Dict, Tuple, TypedDict
+from typing import Callable, List, Dict, Optional, Tuple, TypedDict
 from astrapy import DataAPIClient
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, START, END
 
-# Configure logging
+# Configure logging: records are formatted by the QueueHandler and written to file/console by a
+# background QueueListener, so log calls on the request path never block on disk I/O
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('workflow.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('workflow.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on exit
 logger = logging.getLogger(__name__)
 
 # Set astrapy logging to INFO for debugging
@@ -30,6 +44,23 @@ ASTRA_DB_ENDPOINT = os.getenv("ASTRA_DB_ENDPOINT")
 ASTRA_DB_TOKEN = os.getenv("ASTRA_DB_TOKEN")
 USERINTERESTS_COLLECTION = os.getenv("USERINTERESTS_COLLECTION", "userinterests")
 ADVERTISEMENTS_COLLECTION = os.getenv("ADVERTISEMENTS_COLLECTION", "advertisements")
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+AD_SEARCH_CACHE_TTL_SECONDS = float(os.getenv("AD_SEARCH_CACHE_TTL_SECONDS", "300"))
+AD_SEARCH_CACHE_SIZE = int(os.getenv("AD_SEARCH_CACHE_SIZE", "10000"))
+INTEREST_DEDUP_THRESHOLD = float(os.getenv("INTEREST_DEDUP_THRESHOLD", "0.95"))
+QUANTIZE_INTEREST_VECTORS = os.getenv("QUANTIZE_INTEREST_VECTORS", "false").lower() in ("1", "true", "yes")
+INTEREST_QUANT_SCALE = 127  # Unit-vector components in [-1, 1] map to int8 [-127, 127]
+SIMILARITY_THRESHOLD = 0.7
+_AUTOPLAY_SUFFIX = "&autoplay=1&mute=1"
+# Ads fetched per interest vector; over-fetches the top 5 because ads without a video link
+# and repeated products or URLs are dropped after the search
+AD_SEARCH_LIMIT = int(os.getenv("AD_SEARCH_LIMIT", "10"))
+# Opt-in: cancel the remaining searches once an ad scores EARLY_STOP_SCORE and 5 distinct products
+# are in hand. Results then depend on search completion order and earlier cached users, so it is off by default
+EARLY_STOP_SEARCHES = os.getenv("EARLY_STOP_SEARCHES", "false").lower() in ("1", "true", "yes")
+EARLY_STOP_SCORE = float(os.getenv("EARLY_STOP_SCORE", "0.9"))
+USE_LANGGRAPH = os.getenv("USE_LANGGRAPH", "false").lower() in ("1", "true", "yes")
 
 if not ASTRA_DB_ENDPOINT or not ASTRA_DB_TOKEN:
     logger.error("Missing required environment variables: ASTRA_DB_ENDPOINT or ASTRA_DB_TOKEN")
@@ -39,8 +70,20 @@ logger.info("Environment variables loaded")
 logger.debug("ASTRA_DB_ENDPOINT: %s", ASTRA_DB_ENDPOINT)
 logger.debug("ASTRA_DB_TOKEN: %s", ASTRA_DB_TOKEN)
 
+# Startup work runs in the app lifespan, before the first request is served
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_astra_connections()
+    yield
+
 # FastAPI app
-app = FastAPI(title="Recommendation API", description="API for generating product recommendations using Astra DB", version="7.1")
+app = FastAPI(
+    title="Recommendation API",
+    description="API for generating product recommendations using Astra DB",
+    version="7.1",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # Pydantic models for response
 class Recommendation(BaseModel):
@@ -61,21 +104,98 @@ class RecommendationResponse(BaseModel):
 class WorkflowState(TypedDict):
     customer_id: str
     user_interests: dict
-    user_vectors_with_interests: list  # List of (vector, InterestName, InterestDescription) tuples
+    user_vectors_with_interests: list  # List of (float32 vector, InterestName, InterestDescription) tuples
     ad_url: str
     product: str
     similarity_score: float
     play_ad: bool
     top_recommendations: list
 
-# Initialize Astra DB client
+# Initialize Astra DB client; one shared async database, so no node blocks the event loop on a query
 client = DataAPIClient(ASTRA_DB_TOKEN)
-db = client.get_database_by_api_endpoint(ASTRA_DB_ENDPOINT)
+db = client.get_async_database(ASTRA_DB_ENDPOINT)
 userinterests_collection = db.get_collection(USERINTERESTS_COLLECTION)
 advertisements_collection = db.get_collection(ADVERTISEMENTS_COLLECTION)
 
+async def warm_astra_connections():
+    """Open the HTTP connection to Astra DB before the first request arrives, so that request skips DNS and TLS setup."""
+    try:
+        await asyncio.gather(
+            userinterests_collection.find_one({}, projection={"_id": 1}),
+            advertisements_collection.find_one({}, projection={"_id": 1})
+        )
+        logger.info("Astra DB connections warmed")
+    except Exception as e:
+        logger.warning("Failed to warm Astra DB connections: %s", str(e))
+
+# In-process caches: user interests by UserId, similarity search results by (InterestName, InterestDescription)
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+ad_search_cache = TTLCache(maxsize=AD_SEARCH_CACHE_SIZE, ttl=AD_SEARCH_CACHE_TTL_SECONDS)
+
+# Drop repeated interests before they reach the similarity search
+def deduplicate_interest_vectors(user_vectors: np.ndarray, interests: List[Tuple[str, str]]) -> List[int]:
+    """Return the indices to keep: the first vector per (InterestName, InterestDescription), minus near-duplicates of a kept vector."""
+    norms = np.linalg.norm(user_vectors, axis=1, keepdims=True)
+    unit_vectors = user_vectors / np.where(norms == 0, 1, norms)
+    if QUANTIZE_INTEREST_VECTORS:
+        quantized = np.round(unit_vectors * INTEREST_QUANT_SCALE).astype(np.int8)
+        similarities = np.matmul(quantized, quantized.T, dtype=np.int32) / INTEREST_QUANT_SCALE ** 2
+    else:
+        similarities = unit_vectors @ unit_vectors.T
+    seen_interests = set()
+    kept = []
+    for idx, interest in enumerate(interests):
+        if interest in seen_interests:
+            continue
+        seen_interests.add(interest)
+        if kept and similarities[idx, kept].max() >= INTEREST_DEDUP_THRESHOLD:
+            logger.info("Skipping near-duplicate interest vector (Interest: %s, Description: %s)", *interest)
+            continue
+        kept.append(idx)
+    return kept
+
+# Run one similarity search per vector concurrently, optionally stopping early
+async def batch_similarity_search(vectors: List[np.ndarray], k: int = AD_SEARCH_LIMIT,
+                                  is_done: Optional[Callable[[List[Optional[list]]], bool]] = None) -> List[Optional[list]]:
+    """Return the top-k advertisements for each vector, in input order; searches still pending once is_done holds are cancelled and left as None."""
+    async def search(idx: int, vector: np.ndarray) -> Tuple[int, list]:
+        return idx, await advertisements_collection.find(
+            {},
+            sort={"$vector": vector.tolist()},
+            limit=k,
+            include_similarity=True,
+            projection={"_id": 0, "product": 1, "video_link": 1},
+        ).to_list()
+
+    results = [None] * len(vectors)
+    tasks = [asyncio.create_task(search(idx, vector)) for idx, vector in enumerate(vectors)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            idx, top_ads = await next_result
+            results[idx] = top_ads
+            if is_done is not None and is_done(results):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Collect cancelled or failed searches so asyncio never reports an unretrieved task exception
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+# Check whether the ads found so far can already fill a confident response
+def results_are_confident(ad_lists: List[Optional[list]]) -> bool:
+    """Return True once some linked ad scores EARLY_STOP_SCORE or more and 5 distinct linked products were found."""
+    best_score = 0.0
+    products = set()
+    for top_ads in ad_lists:
+        for ad in top_ads or ():
+            if ad.get("video_link"):
+                best_score = max(best_score, ad.get("$similarity", 0.0))
+                products.add(ad.get("product", ""))
+    return best_score >= EARLY_STOP_SCORE and len(products) >= 5
+
 # Agent 1: CustomerID Selection Node
-def agent_1_node(state: WorkflowState) -> WorkflowState:
+async def agent_1_node(state: WorkflowState) -> WorkflowState:
     logger.info("Starting agent_1_node with UserId: %s", state["customer_id"])
     try:
         customer_id = state["customer_id"]
@@ -83,37 +203,49 @@ def agent_1_node(state: WorkflowState) -> WorkflowState:
             logger.error("No CustomerID provided")
             raise ValueError("No CustomerID provided")
 
-        entries = list(userinterests_collection.find(
-            {"UserId": customer_id},
-            projection={"UserId": 1, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
-        ))
-        if not entries:
-            logger.error("No entries found for UserId: %s", customer_id)
-            raise ValueError(f"No entries found for UserId: {customer_id}")
-
-        user_interests = {
-            "InterestName": ", ".join(set(entry.get("InterestName", "") for entry in entries)),
-            "InterestDescription": ", ".join(set(entry.get("InterestDescription", "") for entry in entries))
-        }
-        user_vectors_with_interests = [
-            (entry.get("$vector", []), entry.get("InterestName", ""), entry.get("InterestDescription", ""))
-            for entry in entries if entry.get("$vector", [])
-        ]
-        if not user_vectors_with_interests:
-            logger.error("No valid $vector found for UserId: %s", customer_id)
-            raise ValueError(f"No valid $vector found for UserId: {customer_id}")
+        cached_user = user_cache.get(customer_id)
+        if cached_user is not None:
+            logger.info("Using cached interests for UserId: %s", customer_id)
+            user_interests, user_vectors_with_interests = cached_user
+        else:
+            entries = await userinterests_collection.find(
+                {"UserId": customer_id},
+                projection={"_id": 0, "InterestName": 1, "InterestDescription": 1, "$vector": 1}
+            ).to_list()
+            if not entries:
+                logger.error("No entries found for UserId: %s", customer_id)
+                raise ValueError(f"No entries found for UserId: {customer_id}")
+
+            # Dict keys dedupe like a set but keep the order interests were stored in
+            interest_names, interest_descriptions = {}, {}
+            for entry in entries:
+                interest_names[entry.get("InterestName", "")] = None
+                interest_descriptions[entry.get("InterestDescription", "")] = None
+            user_interests = {
+                "InterestName": ", ".join(interest_names),
+                "InterestDescription": ", ".join(interest_descriptions)
+            }
+            vector_entries = [entry for entry in entries if entry.get("$vector", [])]
+            if not vector_entries:
+                logger.error("No valid $vector found for UserId: %s", customer_id)
+                raise ValueError(f"No valid $vector found for UserId: {customer_id}")
+
+            # One contiguous float32 matrix; each tuple holds a row of it, converted to a list only for Astra DB
+            user_vectors = np.asarray([entry["$vector"] for entry in vector_entries], dtype=np.float32)
+            interests = [(entry.get("InterestName", ""), entry.get("InterestDescription", "")) for entry in vector_entries]
+            kept = deduplicate_interest_vectors(user_vectors, interests)
+            user_vectors = user_vectors[kept]
+            user_vectors_with_interests = [
+                (user_vector, *interests[idx]) for user_vector, idx in zip(user_vectors, kept)
+            ]
+            user_cache[customer_id] = (user_interests, user_vectors_with_interests)
 
         logger.info("Retrieved data for CustomerID: %s, Interests: %s, Number of Vectors: %s", 
                     customer_id, user_interests, len(user_vectors_with_interests))
+        # Return only the keys this node changes; LangGraph merges them into the state
         return {
-            "customer_id": customer_id,
             "user_interests": user_interests,
-            "user_vectors_with_interests": user_vectors_with_interests,
-            "ad_url": state.get("ad_url", ""),
-            "product": "",
-            "similarity_score": 0.0,
-            "play_ad": False,
-            "top_recommendations": []
+            "user_vectors_with_interests": user_vectors_with_interests
         }
 
     except Exception as e:
@@ -121,64 +253,111 @@ def agent_1_node(state: WorkflowState) -> WorkflowState:
         raise
 
 # Agent 2: Advertisement Selection Node (Selection Approach Only)
-def agent_2_node(state: WorkflowState) -> WorkflowState:
+async def agent_2_node(state: WorkflowState) -> WorkflowState:
     logger.info("Starting agent_2_node with CustomerID: %s", state["customer_id"])
     try:
-        all_recommendations = []
-        for idx, (user_vector, interest_name, interest_description) in enumerate(state["user_vectors_with_interests"]):
-            logger.info("Performing similarity search for vector %s/%s (Interest: %s, Description: %s)", 
-                        idx + 1, len(state["user_vectors_with_interests"]), interest_name, interest_description)
-            top_ads = list(advertisements_collection.find(
-                {},
-                sort={"$vector": user_vector},
-                limit=10,
-                include_similarity=True,
-                projection={"product": 1, "video_link": 1},
-            ))
+        user_vectors_with_interests = state["user_vectors_with_interests"]
+
+        # Serve repeat interests from the search cache and only query Astra DB for the rest
+        top_ads_by_interest = {}
+        uncached_vectors = {}
+        for user_vector, interest_name, interest_description in user_vectors_with_interests:
+            key = (interest_name, interest_description)
+            if key in top_ads_by_interest or key in uncached_vectors:
+                continue
+            cached_ads = ad_search_cache.get(key)
+            if cached_ads is None:
+                uncached_vectors[key] = user_vector
+            else:
+                top_ads_by_interest[key] = cached_ads
+
+        # With EARLY_STOP_SEARCHES, stop once the results in hand are confident; skipped interests are left as None
+        cached_results = list(top_ads_by_interest.values())
+        if uncached_vectors and not (EARLY_STOP_SEARCHES and results_are_confident(cached_results)):
+            logger.info("Performing %s similarity searches concurrently (%s served from cache)",
+                        len(uncached_vectors), len(cached_results))
+            search_results = await batch_similarity_search(
+                list(uncached_vectors.values()),
+                is_done=(lambda searched: results_are_confident(cached_results + searched)) if EARLY_STOP_SEARCHES else None
+            )
+            for key, top_ads in zip(uncached_vectors, search_results):
+                if top_ads is not None:
+                    ad_search_cache[key] = top_ads_by_interest[key] = top_ads
+            skipped = search_results.count(None)
+            if skipped:
+                logger.info("Skipped %s similarity searches after reaching confident results", skipped)
+        results = [top_ads_by_interest.get((interest_name, interest_description))
+                   for _, interest_name, interest_description in user_vectors_with_interests]
+
+        # agent_3 would reject the top match anyway, so skip ranking when no rankable (linked) ad clears
+        # the threshold; with no linked ads at all, fall through to the "No advertisements found" error
+        linked_scores = [ad.get("$similarity", 0.0) for top_ads in results for ad in top_ads or () if ad.get("video_link")]
+        best_score = max(linked_scores, default=0.0)
+        if linked_scores and best_score < SIMILARITY_THRESHOLD:
+            logger.warning("Best similarity score %s below threshold %s, skipping recommendation ranking",
+                           best_score, SIMILARITY_THRESHOLD)
+            return {
+                "ad_url": "",
+                "product": "",
+                "similarity_score": 0.0,
+                "top_recommendations": []
+            }
+
+        # Keep the best-ranked recommendation per product in a single pass over every vector's results
+        best_by_product = {}
+        duplicate_count = 0
+        seen_at = 0  # Position of each linked ad across all vectors, the final tiebreak on equal (score, vector)
+        log_vector_details = logger.isEnabledFor(logging.INFO)
+        for idx, ((_, interest_name, interest_description), top_ads) in enumerate(zip(user_vectors_with_interests, results)):
+            if top_ads is None:
+                continue
             if not top_ads:
                 logger.warning("No advertisements found for vector %s", idx + 1)
                 continue
 
-            seen_products = set()
             vector_recommendations = []
             for ad in top_ads:
-                product = ad.get("product", "")
-                if product in seen_products:
-                    logger.warning("Duplicate product found in search results for vector %s: %s", idx + 1, product)
+                video_link = ad.get("video_link")
+                if not video_link:
+                    continue
+                rec = {
+                    "url": video_link + _AUTOPLAY_SUFFIX,
+                    "product": ad.get("product", ""),
+                    "score": ad.get("$similarity", 0.0),
+                    "vector_idx": idx,
+                    "seen_at": seen_at
+                }
+                seen_at += 1
+                if log_vector_details and len(vector_recommendations) < 5:
+                    vector_recommendations.append(rec)
+                current = best_by_product.get(rec["product"])
+                if current is None:
+                    best_by_product[rec["product"]] = rec
                     continue
-                ad_url = ad.get("video_link", "") + "&autoplay=1&mute=1" if ad.get("video_link") else ""
-                if ad_url:
-                    vector_recommendations.append({
-                        "url": ad_url,
-                        "product": product,
-                        "score": ad.get("$similarity", 0.0),
-                        "vector_idx": idx
-                    })
-                    seen_products.add(product)
+                duplicate_count += 1
+                if (rec["score"], -idx) > (current["score"], -current["vector_idx"]):
+                    best_by_product[rec["product"]] = rec
 
             if vector_recommendations:
-                logger.info("Top recommendations for vector %s (Interest: %s, Description: %s):", 
-                            idx + 1, interest_name, interest_description)
-                for rec in vector_recommendations[:5]:
-                    logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-            all_recommendations.extend(vector_recommendations)
-
-        if not all_recommendations:
+                logger.info("Top recommendations for vector %s (Interest: %s, Description: %s): %s",
+                            idx + 1, interest_name, interest_description,
+                            "; ".join("URL: %s, Product: %s, Score: %s" % (rec["url"], rec["product"], rec["score"])
+                                      for rec in vector_recommendations))
+
+        if duplicate_count:
+            logger.warning("Dropped %s duplicate product recommendations across all vectors", duplicate_count)
+        if not best_by_product:
             logger.error("No advertisements found across all vectors (Selection Approach)")
             raise ValueError("No advertisements found across all vectors (Selection Approach)")
 
-        seen_products = set()
-        deduplicated_recommendations = []
-        all_recommendations.sort(key=lambda x: (x["score"], -x["vector_idx"]), reverse=True)
-        for rec in all_recommendations:
-            product = rec["product"]
-            if product in seen_products:
-                logger.warning("Duplicate product found across all recommendations: %s", product)
-                continue
-            deduplicated_recommendations.append(rec)
-            seen_products.add(product)
+        # Heapify instead of sorting: only as many records are popped as it takes to find 5 distinct URLs.
+        # Ranking is score, then lower vector index, then first seen, the same order a stable sort gave
+        ranked_recommendations = [
+            (-rec["score"], rec["vector_idx"], rec["seen_at"], rec) for rec in best_by_product.values()
+        ]
+        heapify(ranked_recommendations)
 
-        top_match = deduplicated_recommendations[0]
+        top_match = ranked_recommendations[0][3]
         ad_url = top_match["url"]
         product = top_match["product"]
         similarity_score = top_match["score"]
@@ -186,34 +365,28 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
                     top_match["vector_idx"] + 1, ad_url, product, similarity_score)
 
         seen_urls = set()
-        top_recommendations = [{
-            "url": top_match["url"],
-            "product": top_match["product"],
-            "score": top_match["score"]
-        }]
-        seen_urls.add(top_match["url"])
-
-        for rec in deduplicated_recommendations[1:]:
-            if rec["url"] not in seen_urls and len(top_recommendations) < 5:
-                top_recommendations.append({
-                    "url": rec["url"],
-                    "product": rec["product"],
-                    "score": rec["score"]
-                })
-                seen_urls.add(rec["url"])
-
-        logger.info("Top 5 aggregated recommendations (Selection Approach):")
-        for rec in top_recommendations:
-            logger.info("  - URL: %s, Product: %s, Score: %s", rec["url"], rec["product"], rec["score"])
-
+        top_recommendations = []
+        while ranked_recommendations and len(top_recommendations) < 5:
+            rec = heappop(ranked_recommendations)[3]
+            if rec["url"] in seen_urls:
+                continue
+            seen_urls.add(rec["url"])
+            top_recommendations.append({
+                "url": rec["url"],
+                "product": rec["product"],
+                "score": rec["score"]
+            })
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Top 5 aggregated recommendations (Selection Approach): %s",
+                        "; ".join("URL: %s, Product: %s, Score: %s" % (rec["url"], rec["product"], rec["score"])
+                                  for rec in top_recommendations))
+
+        # play_ad is decided in agent_3_node
         return {
-            "customer_id": state["customer_id"],
-            "user_interests": state["user_interests"],
-            "user_vectors_with_interests": state["user_vectors_with_interests"],
             "ad_url": ad_url,
             "product": product,
             "similarity_score": similarity_score,
-            "play_ad": False,  # Will be decided in agent_3_node
             "top_recommendations": top_recommendations
         }
 
@@ -222,9 +395,8 @@ def agent_2_node(state: WorkflowState) -> WorkflowState:
         raise
 
 # Agent 3: Similarity Score Validation Node
-def agent_3_node(state: WorkflowState) -> WorkflowState:
+async def agent_3_node(state: WorkflowState) -> WorkflowState:
     logger.info("Starting agent_3_node, evaluating similarity score: %s", state["similarity_score"])
-    SIMILARITY_THRESHOLD = 0.7
     DEFAULT_AD_URL = "https://www.youtube.com/watch?v=default_ad&autoplay=1&mute=1"
     DEFAULT_PRODUCT = "Generic Product"
 
@@ -233,36 +405,24 @@ def agent_3_node(state: WorkflowState) -> WorkflowState:
             "Similarity score %s meets threshold %s, approving advertisement (Selection Approach): %s",
             state["similarity_score"], SIMILARITY_THRESHOLD, state["ad_url"]
         )
-        play_ad = True
-    else:
-        logger.warning(
-            "Similarity score %s below threshold %s, using default advertisement (Selection Approach), interests: %s",
-            state["similarity_score"], SIMILARITY_THRESHOLD, state["user_interests"]
-        )
-        play_ad = False
-        state["ad_url"] = DEFAULT_AD_URL
-        state["product"] = DEFAULT_PRODUCT
-        state["similarity_score"] = 0.0
-        state["top_recommendations"] = []
+        return {"play_ad": True}
 
+    logger.warning(
+        "Similarity score %s below threshold %s, using default advertisement (Selection Approach), interests: %s",
+        state["similarity_score"], SIMILARITY_THRESHOLD, state["user_interests"]
+    )
     return {
-        "customer_id": state["customer_id"],
-        "user_interests": state["user_interests"],
-        "user_vectors_with_interests": state["user_vectors_with_interests"],
-        "ad_url": state["ad_url"],
-        "product": state["product"],
-        "similarity_score": state["similarity_score"],
-        "play_ad": play_ad,
-        "top_recommendations": state["top_recommendations"]
+        "ad_url": DEFAULT_AD_URL,
+        "product": DEFAULT_PRODUCT,
+        "similarity_score": 0.0,
+        "play_ad": False,
+        "top_recommendations": []
     }
 
 # Error Handler Node
-def error_handler_node(state: WorkflowState) -> WorkflowState:
+async def error_handler_node(state: WorkflowState) -> WorkflowState:
     logger.error("Error handler triggered: No valid CustomerID or recommendations found")
     return {
-        "customer_id": state["customer_id"],
-        "user_interests": state.get("user_interests", {}),
-        "user_vectors_with_interests": state.get("user_vectors_with_interests", []),
         "ad_url": "https://www.youtube.com/watch?v=default_video&autoplay=1&mute=1",
         "product": "",
         "similarity_score": 0.0,
@@ -289,23 +449,39 @@ workflow.add_edge("error_handler", END)
 # Compile the graph
 graph = workflow.compile()
 
+# Run the workflow for one UserId
+async def run_pipeline(customer_id: str) -> dict:
+    """Run the agents in sequence on a plain dict, or through the LangGraph graph when USE_LANGGRAPH is set."""
+    state = {
+        "customer_id": customer_id,
+        "user_interests": {},
+        "user_vectors_with_interests": [],
+        "ad_url": "",
+        "product": "",
+        "similarity_score": 0.0,
+        "play_ad": False,
+        "top_recommendations": []
+    }
+    if USE_LANGGRAPH:
+        return await graph.ainvoke(state)
+
+    # Same routing as the graph: START -> agent_1 -> (agent_2 -> agent_3 | error_handler) -> END
+    state.update(await agent_1_node(state))
+    if not state["customer_id"]:
+        state.update(await error_handler_node(state))
+        return state
+    state.update(await agent_2_node(state))
+    state.update(await agent_3_node(state))
+    return state
+
 @app.get("/recommend/{user_id}", response_model=RecommendationResponse)
 async def get_recommendations(user_id: str):
     """API endpoint to get product recommendations for a specified UserId using the Selection Approach."""
     try:
         logger.info("Received request for recommendations for UserId: %s", user_id)
 
-        # Invoke the LangGraph workflow with the prescribed UserId
-        result = graph.invoke({
-            "customer_id": user_id,
-            "user_interests": {},
-            "user_vectors_with_interests": [],
-            "ad_url": "",
-            "product": "",
-            "similarity_score": 0.0,
-            "play_ad": False,
-            "top_recommendations": []
-        })
+        # Run the workflow with the prescribed UserId
+        result = await run_pipeline(user_id)
 
         # Check if the workflow failed to produce a valid result
         if not result["customer_id"] or not result["top_recommendations"]:
@@ -341,17 +517,8 @@ async def get_top_recommended_url(user_id: str):
     try:
         logger.info("Received request for top recommended URL for UserId: %s", user_id)
 
-        # Invoke the LangGraph workflow with the prescribed UserId
-        result = graph.invoke({
-            "customer_id": user_id,
-            "user_interests": {},
-            "user_vectors_with_interests": [],
-            "ad_url": "",
-            "product": "",
-            "similarity_score": 0.0,
-            "play_ad": False,
-            "top_recommendations": []
-        })
+        # Run the workflow with the prescribed UserId
+        result = await run_pipeline(user_id)
 
         # Check if the workflow failed to produce a valid result
         if not result["customer_id"] or not result["top_recommendations"]: